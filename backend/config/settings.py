@@ -136,6 +136,9 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / "db.sqlite3",
+        # file-backed test database: the concurrent-submission tests need real SQLite
+        # locking between threads (shared in-memory databases fail with "table is locked")
+        'TEST': {'NAME': BASE_DIR / "test_db.sqlite3"},
     }
 }
 
@@ -198,6 +201,21 @@ EMAIL_USE_SSL = False
 EMAIL_HOST_USER = "apikey"  # literal word required by SendGrid
 
 DEFAULT_FROM_EMAIL = "info@confideoit.com"
+
+# ID card PDF generation: embed cards losslessly or as JPEG (smaller, faster)
+IDCARD_IMAGE_FORMAT = "lossless"
+IDCARD_JPEG_QUALITY = 90
+# rendered-card cache for repeat generation runs (set IDCARD_CACHE_DIR = None to disable)
+IDCARD_CACHE_DIR = os.path.join(BASE_DIR, "cache", "idcards")
+IDCARD_CACHE_MAX_BYTES = 2 * 1024 ** 3
+# local copies of remote (S3) photos/backgrounds read while rendering, keyed by ETag + size
+IDCARD_STORAGE_CACHE_DIR = os.path.join(BASE_DIR, "cache", "media")
+IDCARD_STORAGE_CACHE_MAX_BYTES = 5 * 1024 ** 3
+# parent-facing upload-link pages cache the resolved link (idms.link_cache); use a shared
+# CACHES backend in production so edits reach every process before this TTL
+IDCARD_PUBLIC_LINK_CACHE_TTL = 300
+# per-phase render timings (also per request via ?timings=1); logged on "idms.render"
+IDCARD_RENDER_TIMINGS = False
 FRONTEND_URL = "http://localhost:5173"
 
 
@@ -0,0 +1,86 @@
+# backend/idms/card_cache.py
+"""
+Content-addressed on-disk cache of rendered ID cards.
+
+A card is stored under a key derived from everything that affects its pixels:
+the renderer version (utils.RENDER_VERSION), the template version (fields +
+background file identity), the student's render inputs (see RenderPlan.fingerprint)
+and the PDF embedding format. Regenerating a class after fixing one student therefore
+re-renders only that student's card.
+"""
+import hashlib
+import io
+import os
+
+from PIL import Image
+
+from .disk_cache import DiskLRUCache
+from .utils import RENDER_VERSION, background_cache
+
+
+class RenderedCardCache(DiskLRUCache):
+    """Encoded cards (JPEG or lossless PNG) stored by card_key()."""
+
+    # ---------- keys ----------
+    @staticmethod
+    def run_key(template, plan, image_format, jpeg_quality):
+        """Digest shared by every card of one template/format combination."""
+        try:
+            bg = background_cache.key(template)[1:]
+        except Exception:
+            bg = None
+        quality = jpeg_quality if image_format == "jpeg" else None
+        raw = repr((RENDER_VERSION, plan.template_id, plan.digest, plan.size, plan.draft, plan.vector_text, bg, image_format, quality))
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    @staticmethod
+    def card_key(run_key, student_fingerprint):
+        return hashlib.sha1(f"{run_key}:{student_fingerprint}".encode()).hexdigest()
+
+    def _path(self, key, image_format):
+        ext = "jpg" if image_format == "jpeg" else "png"
+        return os.path.join(self.root, key[:2], f"{key}.{ext}")
+
+    # ---------- read / write ----------
+    def get(self, key, image_format):
+        """Return the cached card in encode_card() form, or None."""
+        path = self._path(key, image_format)
+        try:
+            with open(path, "rb") as fh:
+                data = fh.read()
+        except OSError:
+            self._count(hit=False)
+            return None
+        self.touch(path)  # bump recency for LRU
+        self._count(hit=True)
+        if image_format == "jpeg":
+            return data
+        img = Image.open(io.BytesIO(data))
+        img.load()
+        return img
+
+    def put(self, key, encoded, image_format):
+        """Store a card given in encode_card() form (JPEG bytes or a PIL image)."""
+        if isinstance(encoded, bytes):
+            data = encoded
+        else:
+            out = io.BytesIO()
+            # fast, lossless; only paid on a cache miss
+            encoded.save(out, format="PNG", compress_level=1)
+            data = out.getvalue()
+        self.write(self._path(key, image_format), lambda fh: fh.write(data))
+
+
+_default_cache = None
+
+
+def get_card_cache():
+    """The process-wide cache configured by IDCARD_CACHE_DIR / IDCARD_CACHE_MAX_BYTES (None if disabled)."""
+    global _default_cache
+    from django.conf import settings
+    root = getattr(settings, "IDCARD_CACHE_DIR", None)
+    if not root:
+        return None
+    if _default_cache is None or _default_cache.root != str(root):
+        _default_cache = RenderedCardCache(root, getattr(settings, "IDCARD_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+    return _default_cache
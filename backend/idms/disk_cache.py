@@ -0,0 +1,114 @@
+# backend/idms/disk_cache.py
+"""
+Size-bounded directory of cache files, shared by the rendered-card cache
+(idms.card_cache) and the remote media cache (idms.storage_cache).
+"""
+import os
+import tempfile
+import threading
+
+
+class DiskLRUCache:
+    """
+    Files under `root`, evicted least-recently-used (by mtime) once the directory grows
+    past `max_bytes`. Safe to share between processes: writes are atomic renames and
+    eviction tolerates files vanishing underneath it. Subclasses decide the file layout.
+    """
+    def __init__(self, root, max_bytes=2 * 1024 ** 3):
+        self.root = str(root)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._bytes = None  # lazily measured
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # shipped to render worker processes: counters and the lock stay behind
+        return {"root": self.root, "max_bytes": self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    @staticmethod
+    def touch(path):
+        """Bump `path`'s recency; False if it is not in the cache."""
+        try:
+            os.utime(path)
+        except OSError:
+            return False
+        return True
+
+    def write(self, path, fill):
+        """
+        Atomically create `path` from `fill(fh)` (fh: a binary file in the same directory),
+        then evict if the cache outgrew max_bytes. Returns False if it could not be written;
+        exceptions raised by `fill` propagate, leaving nothing behind.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                fill(fh)
+            size = os.path.getsize(tmp)
+            os.replace(tmp, path)
+        except BaseException as e:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            if isinstance(e, OSError):
+                return False
+            raise
+
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = self._scan_size()
+            else:
+                self._bytes += size
+            over = self.max_bytes is not None and self._bytes > self.max_bytes
+        if over:
+            self.evict(keep=path)
+        return True
+
+    # ---------- eviction ----------
+    def _entries(self):
+        for dirpath, _dirs, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield st.st_mtime, st.st_size, path
+
+    def _scan_size(self):
+        return sum(size for _m, size, _p in self._entries())
+
+    def evict(self, target_ratio=0.9, keep=None):
+        """Delete least-recently-used files until the cache is under target_ratio * max_bytes."""
+        entries = sorted(self._entries())
+        total = sum(size for _m, size, _p in entries)
+        target = int(self.max_bytes * target_ratio)
+        for _mtime, size, path in entries:
+            if total <= target:
+                break
+            if path == keep:
+                continue
+            try:
+                os.unlink(path)
+                total -= size
+            except OSError:
+                pass
+        with self._lock:
+            self._bytes = total
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "bytes": self._bytes}
@@ -0,0 +1,371 @@
+# backend/idms/jobs.py
+"""
+ID-card generation shared by the synchronous `generate_ids` endpoint and the
+background job worker (`manage.py run_generation_jobs`).
+
+Jobs live in the database (GenerationJob); the worker claims them with a
+conditional UPDATE, so no broker is needed and several workers can run at once.
+"""
+import io
+import itertools
+import json
+import logging
+import os
+import socket
+import tempfile
+import time
+import traceback
+import zipfile
+
+from django.conf import settings
+from django.core.files import File
+from django.db.models import QuerySet
+from django.utils import timezone
+from django.utils.text import slugify
+
+from .card_cache import get_card_cache
+from .models import MAX_RENDER_DPI, MIN_RENDER_DPI, ClassRoom, GenerationJob, IdCardTemplate, Student
+from .utils import CARD_IMAGE_FORMATS, RenderTimings, cards_per_page, generate_id_cards, student_attribute_names
+
+# one JSON line per instrumented run
+render_logger = logging.getLogger("idms.render")
+
+IDCARD_IMAGE_FORMAT = getattr(settings, "IDCARD_IMAGE_FORMAT", "lossless")
+IDCARD_JPEG_QUALITY = getattr(settings, "IDCARD_JPEG_QUALITY", 90)
+# collect per-phase render timings unless the request says otherwise
+IDCARD_RENDER_TIMINGS = getattr(settings, "IDCARD_RENDER_TIMINGS", False)
+MIN_DPI, MAX_DPI = MIN_RENDER_DPI, MAX_RENDER_DPI
+# split=classroom|pages: one PDF per classroom, or per `pages_per_file` sheets, in a streamed ZIP
+SPLIT_MODES = ("classroom", "pages")
+DEFAULT_PAGES_PER_FILE = getattr(settings, "IDCARD_PAGES_PER_FILE", 50)
+ZIP_CHUNK_SIZE = 1024 * 1024
+CLASS_BREAKS = ("page", "separator", "none")
+# students fetched per round trip while streaming a run
+GENERATION_CHUNK_SIZE = getattr(settings, "IDCARD_GENERATION_CHUNK_SIZE", 500)
+# how often a running job writes its progress row
+JOB_PROGRESS_INTERVAL_SECONDS = getattr(settings, "GENERATION_JOB_PROGRESS_INTERVAL", 1.0)
+
+
+class GenerationError(Exception):
+    """Bad or unsatisfiable generation parameters; the message is safe to show to the client."""
+
+
+def parse_generation_params(data):
+    """
+    Validate generate_ids-style parameters (query params or request body) into a
+    plain, JSON-serializable dict. Raises GenerationError.
+    """
+    split = data.get("split") or None
+    if split is not None and split not in SPLIT_MODES:
+        raise GenerationError(f"split must be one of {', '.join(SPLIT_MODES)}.")
+    # leaving out classroom means the whole school
+    if not data.get("school"):
+        raise GenerationError("school is required.")
+    try:
+        school_id = int(data.get("school"))
+        class_id = int(data.get("classroom")) if data.get("classroom") else None
+    except (TypeError, ValueError):
+        raise GenerationError("school and classroom must be ids.")
+
+    pages_per_file = None
+    if split == "pages":
+        try:
+            pages_per_file = int(data.get("pages_per_file") or DEFAULT_PAGES_PER_FILE)
+        except (TypeError, ValueError):
+            raise GenerationError("pages_per_file must be an integer.")
+        if pages_per_file < 1:
+            raise GenerationError("pages_per_file must be at least 1.")
+
+    # card_size optionally override: "54x86"
+    card_size = None
+    if data.get("card_size"):
+        try:
+            w, h = str(data.get("card_size")).split("x")
+            card_size = {"w": float(w), "h": float(h)}
+        except Exception:
+            card_size = None
+
+    # render processes; clamped to the machine's core count
+    try:
+        workers = int(data.get("workers") or 1)
+    except (TypeError, ValueError):
+        raise GenerationError("workers must be an integer.")
+    workers = max(1, min(workers, os.cpu_count() or 1))
+
+    # image_format=lossless|jpeg, quality=1..95 (jpeg only); defaults come from settings
+    image_format = data.get("image_format") or IDCARD_IMAGE_FORMAT
+    if image_format not in CARD_IMAGE_FORMATS:
+        raise GenerationError(f"image_format must be one of {', '.join(CARD_IMAGE_FORMATS)}.")
+    try:
+        jpeg_quality = max(1, min(95, int(data.get("quality") or IDCARD_JPEG_QUALITY)))
+    except (TypeError, ValueError):
+        raise GenerationError("quality must be an integer.")
+
+    # print resolution override; default is the template's render_dpi
+    dpi = None
+    if data.get("dpi"):
+        try:
+            dpi = int(data.get("dpi"))
+        except (TypeError, ValueError):
+            raise GenerationError("dpi must be an integer.")
+        if not MIN_DPI <= dpi <= MAX_DPI:
+            raise GenerationError(f"dpi must be between {MIN_DPI} and {MAX_DPI}.")
+
+    timings = data.get("timings")
+    timings = IDCARD_RENDER_TIMINGS if timings in (None, "") else str(timings).lower() in ("1", "true", "yes")
+    # text as PDF text (TTF) instead of pixels in the card image
+    vector_text = str(data.get("vector_text") or "").lower() in ("1", "true", "yes")
+
+    # school scope: what goes between classrooms (page = start each class on a new sheet)
+    class_breaks = data.get("class_breaks") or "page"
+    if class_breaks not in CLASS_BREAKS:
+        raise GenerationError(f"class_breaks must be one of {', '.join(CLASS_BREAKS)}.")
+
+    return {
+        "school": school_id,
+        "classroom": class_id,
+        "paper": data.get("paper") or "A4",
+        "card_size": card_size,
+        "workers": workers,
+        "image_format": image_format,
+        "quality": jpeg_quality,
+        "dpi": dpi,
+        "vector_text": vector_text,
+        "split": split,
+        "pages_per_file": pages_per_file,
+        "class_breaks": class_breaks,
+        "timings": timings,
+    }
+
+
+def resolve_template(params):
+    """The school's default IdCardTemplate, with any card_size override applied (not saved)."""
+    try:
+        tmpl = IdCardTemplate.objects.get(school_id=params["school"], is_default=True)
+    except IdCardTemplate.DoesNotExist:
+        raise GenerationError("No default ID card template for this school.")
+    if params.get("card_size"):
+        tmpl.card_size_mm = params["card_size"]
+    return tmpl
+
+
+def students_for(params):
+    qs = Student.objects.filter(school_id=params["school"], status="VERIFIED")
+    if params.get("classroom"):
+        qs = qs.filter(classroom_id=params["classroom"])
+    return qs
+
+
+def stream_students(qs, template):
+    """
+    Iterate `qs` in chunks, loading only the columns the template's fields can read.
+    Relations a field reads (e.g. "classroom.class_name") are joined, not fetched per row.
+    """
+    names = student_attribute_names(template)
+    fields = {f.name: f for f in qs.model._meta.concrete_fields}
+    joined = qs.query.select_related
+    columns = {"id"} | (names & fields.keys()) | (set(joined) if isinstance(joined, dict) else set())
+    relations = [n for n in columns if n in fields and fields[n].is_relation]
+    qs = qs.only(*columns)
+    if relations:
+        qs = qs.select_related(*relations)
+    return qs.iterator(chunk_size=GENERATION_CHUNK_SIZE)
+
+
+def classroom_label(classroom):
+    if classroom is None:
+        return "Unassigned"
+    return f"{classroom.class_name} {classroom.section or ''}".strip()
+
+
+def school_scope_kwargs(params):
+    """
+    For a whole-school run: every classroom in one query, grouped class by class,
+    with a page break (and optionally a separator page) between classes.
+    """
+    students = (students_for(params).select_related("classroom")
+                .order_by("classroom__class_name", "classroom__section", "classroom_id", "id"))
+    kwargs = {"students": students}
+    if params.get("class_breaks", "page") != "none":
+        kwargs["group_by"] = lambda st: classroom_label(st.classroom)
+        kwargs["separator_pages"] = params.get("class_breaks") == "separator"
+    return kwargs
+
+
+def run_generation(params, output=None, progress=None, template=None, timings=None, students=None):
+    """
+    Render the PDF described by `params`; returns the (rewound) output file.
+    `students` overrides students_for(params) (used for split output).
+    With params["timings"] set (or a RenderTimings passed in) the per-phase summary
+    is logged as one JSON line on the "idms.render" logger.
+    """
+    tmpl = template or resolve_template(params)
+    if timings is None and params.get("timings"):
+        timings = RenderTimings()
+    kwargs = {"timings": timings} if timings is not None else {}
+    if students is None and not params.get("classroom"):
+        kwargs.update(school_scope_kwargs(params))
+        students = kwargs.pop("students")
+    if students is None:
+        students = students_for(params)
+    if isinstance(students, QuerySet):
+        students = stream_students(students, tmpl)
+    pdf = generate_id_cards(
+        students, tmpl,
+        paper=params["paper"], workers=params["workers"],
+        image_format=params["image_format"], jpeg_quality=params["quality"],
+        card_cache=get_card_cache(), output=output, progress=progress, dpi=params.get("dpi"),
+        vector_text=params.get("vector_text", False), **kwargs,
+    )
+    if timings is not None:
+        render_logger.info(json.dumps({
+            "event": "idcard_generation", "template": tmpl.pk, "params": params, **timings.summary(),
+        }, default=str))
+    return pdf
+
+
+# ---------- split output ----------
+def iter_shards(params, template):
+    """
+    Yield (file name, students) per output PDF for params["split"]:
+    "classroom" -> one file per classroom (of params["classroom"] only, if given);
+    "pages" -> consecutive files of params["pages_per_file"] sheets each.
+    """
+    if params["split"] == "classroom":
+        classes = ClassRoom.objects.filter(school_id=params["school"]).order_by("class_name", "section", "id")
+        if params.get("classroom"):
+            classes = classes.filter(id=params["classroom"])
+        for n, cls in enumerate(classes, 1):
+            students = students_for({**params, "classroom": cls.id}).order_by("id")
+            if students.exists():
+                name = slugify(f"{cls.class_name} {cls.section or ''}") or f"class-{cls.id}"
+                yield f"{n:02d}-{name}.pdf", students
+        return
+
+    per_file = params["pages_per_file"] * cards_per_page(template, params["paper"])
+    students = stream_students(students_for(params).order_by("classroom_id", "id"), template)
+    for n in itertools.count(1):
+        chunk = list(itertools.islice(students, per_file))
+        if not chunk:
+            return
+        yield f"idcards-{n:03d}.pdf", chunk
+
+
+class _ZipSink(io.RawIOBase):
+    """Write-only, unseekable buffer: zipfile appends, the generator drains."""
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data, self.chunks = b"".join(self.chunks), []
+        return data
+
+
+def stream_generation_zip(params, template=None):
+    """
+    Yield a ZIP archive of the split PDFs as it is produced: each shard is rendered,
+    then streamed into the archive, so the first file arrives before the last is rendered.
+    """
+    tmpl = template or resolve_template(params)
+    sink = _ZipSink()
+    # PDFs are already compressed: store them
+    with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_STORED) as zf:
+        for name, students in iter_shards(params, tmpl):
+            with tempfile.TemporaryFile() as out:
+                run_generation(params, output=out, template=tmpl, students=students)
+                with zf.open(name, mode="w", force_zip64=True) as entry:
+                    for block in iter(lambda: out.read(ZIP_CHUNK_SIZE), b""):
+                        entry.write(block)
+                        yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
+
+
+# ---------- job worker ----------
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def claim_next_job(name=None):
+    """
+    Atomically move the oldest QUEUED job to RUNNING and return it (None if the queue is empty).
+    The conditional UPDATE means two workers can never claim the same job.
+    """
+    name = name or worker_name()
+    while True:
+        job_id = (GenerationJob.objects.filter(status="QUEUED")
+                  .order_by("created_at", "id").values_list("id", flat=True).first())
+        if job_id is None:
+            return None
+        now = timezone.now()
+        claimed = GenerationJob.objects.filter(id=job_id, status="QUEUED").update(
+            status="RUNNING", worker=name, started_at=now, heartbeat_at=now,
+        )
+        if claimed:
+            return GenerationJob.objects.get(id=job_id)
+        # another worker won the race; try the next one
+
+
+def requeue_stale_jobs(stale_after_seconds):
+    """Put RUNNING jobs whose worker stopped heart-beating back on the queue."""
+    cutoff = timezone.now() - timezone.timedelta(seconds=stale_after_seconds)
+    return GenerationJob.objects.filter(status="RUNNING", heartbeat_at__lt=cutoff).update(
+        status="QUEUED", worker="", done=0,
+    )
+
+
+def run_job(job):
+    """Execute a claimed (RUNNING) job to DONE or FAILED."""
+    def owned():
+        # every write is conditional on still owning the job: if it was requeued as stale
+        # and claimed by another worker, this run must not touch it any more
+        return GenerationJob.objects.filter(id=job.id, status="RUNNING", worker=job.worker)
+
+    def heartbeat(**fields):
+        return owned().update(heartbeat_at=timezone.now(), **fields)
+
+    try:
+        params = job.params
+        tmpl = resolve_template(params)
+        total = students_for(params).count()
+        heartbeat(total=total)
+        job.total = total
+
+        last_write = [0.0]
+
+        def progress(count):
+            now = time.monotonic()
+            # the last card always writes, so the heartbeat is fresh when the PDF is saved
+            if count == total or now - last_write[0] >= JOB_PROGRESS_INTERVAL_SECONDS:
+                last_write[0] = now
+                heartbeat(done=count)
+
+        timings = RenderTimings() if params.get("timings") else None
+        with tempfile.TemporaryFile() as out:
+            run_generation(params, output=out, progress=progress, template=tmpl, timings=timings)
+            heartbeat()  # canvas.save() of a big run can take a while
+            out.seek(0)
+            job.result.save(f"idcards-{job.id}.pdf", File(out), save=False)
+        heartbeat()  # and so can the upload
+
+        meta = {**(job.meta or {}), "timings": timings.summary()} if timings is not None else job.meta
+        finished = owned().update(
+            result=job.result.name, status="DONE", done=total, finished_at=timezone.now(), meta=meta,
+        )
+        if not finished:
+            # requeued and picked up by another worker meanwhile: its run wins
+            job.result.storage.delete(job.result.name)
+    except Exception as e:
+        owned().update(
+            status="FAILED", finished_at=timezone.now(),
+            error=str(e) if isinstance(e, GenerationError) else traceback.format_exc(),
+        )
+    job.refresh_from_db()
+    return job
@@ -0,0 +1,97 @@
+# backend/idms/link_cache.py
+"""
+Cached resolution of public upload links for the parent-facing pages.
+
+Every parent page view resolves its token to the school / class names, the form schema
+and the link's validity. The resolved payload is kept in Django's cache under the token,
+so a hit costs no database queries. A miss costs one query (select_related).
+
+Invalidation (once the writing transaction commits, so a concurrent miss cannot
+re-cache the row as it was before):
+- UploadLink save/delete and claim_use drop that token's entry, and the link's previous
+  token's entry when rotate_token replaced it.
+- School, ClassRoom and FormTemplate save/delete bump a generation number that is part
+  of every key, which retires all cached links at once. Those edits are rare next to
+  parent page views.
+
+Entries also expire after IDCARD_PUBLIC_LINK_CACHE_TTL seconds. With the default
+per-process LocMemCache, other processes see changes only after that TTL. Configure a
+shared cache (Redis, Memcached) in production.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+PUBLIC_LINK_CACHE_TTL = getattr(settings, "IDCARD_PUBLIC_LINK_CACHE_TTL", 300)
+_GENERATION_KEY = "idms:public-link:generation"
+_MISSING = "missing"  # cached marker for unknown tokens
+
+
+def _new_generation():
+    # clock-based, so a generation lost to cache eviction never restarts at an old value
+    return int(time.time() * 1000)
+
+
+def _generation():
+    gen = cache.get(_GENERATION_KEY)
+    if gen is None:
+        cache.add(_GENERATION_KEY, _new_generation(), None)
+        gen = cache.get(_GENERATION_KEY)
+    return gen
+
+
+def _key(token):
+    return f"idms:public-link:{_generation()}:{token}"
+
+
+def link_payload(link):
+    """Everything the public link endpoints read, as a plain (picklable) dict."""
+    classroom = link.classroom
+    template = link.template
+    return {
+        "id": link.pk,
+        "school": link.school.name,
+        "class": classroom.class_name,
+        "section": classroom.section,
+        "expires_at": link.expires_at,
+        "is_active": link.is_active,
+        "max_uses": link.max_uses,
+        "uses_count": link.uses_count,
+        "template_id": link.template_id,
+        "fields": template.fields if template is not None else None,
+    }
+
+
+def resolve_link(token):
+    """The cached link_payload() for `token`, or None if no such link exists."""
+    from .models import UploadLink
+
+    key = _key(token)
+    payload = cache.get(key)
+    if payload is None:
+        link = (UploadLink.objects.select_related("school", "classroom", "template")
+                .filter(token=token).first())
+        payload = link_payload(link) if link is not None else _MISSING
+        cache.set(key, payload, PUBLIC_LINK_CACHE_TTL)
+    return None if payload == _MISSING else payload
+
+
+def payload_is_valid(payload):
+    """UploadLink.is_valid() on a cached payload."""
+    return (timezone.now() < payload["expires_at"] and payload["is_active"]
+            and (payload["max_uses"] is None or payload["uses_count"] < payload["max_uses"]))
+
+
+def forget_link(token):
+    """Drop the cached payload of one link (after it was saved, deleted or used)."""
+    cache.delete(_key(token))
+
+
+def bump_link_generation():
+    """Retire every cached link (a school, class or form template changed)."""
+    try:
+        cache.incr(_GENERATION_KEY)
+    except ValueError:  # not set yet, or evicted
+        cache.set(_GENERATION_KEY, _new_generation(), None)
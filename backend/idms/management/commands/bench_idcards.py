@@ -0,0 +1,287 @@
+"""
+Benchmarks for the ID-card rendering and PDF layout engine.
+
+    python manage.py bench_idcards                       # 100 / 1000 / 5000 cards, all templates
+    python manage.py bench_idcards --sizes 100 --templates hexagon --workers 4 --output before.json
+
+Everything is synthetic (templates, backgrounds, photos, students) and seeded, so two
+builds can be compared by diffing the JSON files. No database access is needed.
+"""
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import tempfile
+import time
+import timeit
+
+from django.core.management.base import BaseCommand, CommandError
+from PIL import Image, ImageFilter
+
+from idms import utils
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# 54x86 mm at 600 dpi
+DEFAULT_BACKGROUND_SIZE = (1276, 2031)
+# a phone photo after a typical resize
+DEFAULT_PHOTO_SIZE = (1200, 1600)
+PHOTO_POOL = 16
+# first font that resolves through utils.find_font_path is used for text fields
+BENCH_FONTS = ("arial.ttf", "dejavu/DejaVuSans.ttf", "DejaVuSans.ttf")
+
+
+class SyntheticBackground:
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+
+
+class SyntheticTemplate:
+    """Quacks like IdCardTemplate for render_card_image / generate_id_cards."""
+    def __init__(self, pk, name, background_path, fields):
+        self.pk = pk
+        self.name = name
+        self.background = SyntheticBackground(background_path)
+        self.fields = fields
+        self.card_size_mm = {"w": 54, "h": 86}
+
+
+def _bench_font():
+    return next((f for f in BENCH_FONTS if utils.find_font_path(f)), BENCH_FONTS[0])
+
+
+def _box(x, y, w, h, **extra):
+    return {"x": x, "y": y, "width": w, "height": h, "font": _bench_font(), **extra}
+
+
+def template_fields(kind, bw, bh):
+    """Field layouts in background pixels, scaled to the background size."""
+    sx, sy = bw / 1276.0, bh / 2031.0
+
+    def box(x, y, w, h, **extra):
+        return _box(int(x * sx), int(y * sy), int(w * sx), int(h * sy), **extra)
+
+    if kind == "text":
+        return {
+            "photo": box(438, 260, 400, 480),
+            "full_name": box(100, 820, 1076, 110, size=90, align="center"),
+            "fatherName": box(100, 960, 1076, 80, size=64, align="center"),
+            "dob": box(100, 1080, 500, 70, size=56),
+            "parent_phone": box(676, 1080, 500, 70, size=56, align="right"),
+            "Class": box(100, 1180, 500, 70, size=56),
+            "Roll No": box(676, 1180, 500, 70, size=56, align="right"),
+            "Address": box(100, 1300, 1076, 70, size=56),
+            "Blood Group": box(100, 1400, 500, 70, size=56),
+        }
+    shape = {"photo": "square", "hexagon": "hexagon", "circle": "circle"}[kind]
+    return {
+        "photo": box(188, 200, 900, 1000, shape=shape),
+        "full_name": box(100, 1300, 1076, 110, size=90, align="center"),
+        "Class": box(100, 1450, 1076, 80, size=64, align="center"),
+        "parent_phone": box(100, 1560, 1076, 80, size=64, align="center"),
+    }
+
+
+TEMPLATE_KINDS = ("text", "photo", "hexagon", "circle")
+
+
+def _noise_image(size, seed):
+    """A photo-like raster: smooth colour noise, so encoders do realistic work."""
+    rnd = random.Random(seed)
+    small = Image.effect_noise((max(1, size[0] // 16), max(1, size[1] // 16)), 64).convert("RGB")
+    tint = Image.new("RGB", small.size, (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)))
+    small = Image.blend(small, tint, 0.5)
+    return small.resize(size, Image.BICUBIC).filter(ImageFilter.GaussianBlur(1))
+
+
+def build_fixtures(workdir, background_size, photo_size):
+    bg_path = os.path.join(workdir, "background.png")
+    _noise_image(background_size, 0).save(bg_path)
+    photos = []
+    for i in range(PHOTO_POOL):
+        path = os.path.join(workdir, f"photo_{i}.jpg")
+        _noise_image(photo_size, i + 1).save(path, quality=90)
+        photos.append(path)
+    templates = {
+        kind: SyntheticTemplate(1000 + i, kind, bg_path, template_fields(kind, *background_size))
+        for i, kind in enumerate(TEMPLATE_KINDS)
+    }
+    return templates, photos
+
+
+def synthetic_students(n, photos, seed=0):
+    rnd = random.Random(seed)
+    first = ["Aarav", "Diya", "Ishaan", "Ananya", "Vihaan", "Saanvi", "Krishna", "Meera Lakshmi"]
+    last = ["Sharma", "Reddy", "Venkataraman", "Iyer", "Khan", "Fernandes", "Subramanian"]
+    for i in range(n):
+        yield {
+            "full_name": f"{rnd.choice(first)} {rnd.choice(last)}",
+            "fatherName": f"{rnd.choice(first)} {rnd.choice(last)} {rnd.choice(last)}",
+            "dob": f"{rnd.randint(1, 28):02d}-{rnd.randint(1, 12):02d}-20{rnd.randint(10, 20)}",
+            "parent_phone": f"9{rnd.randint(100000000, 999999999)}",
+            "photo": photos[i % len(photos)],
+            "meta": {
+                "class": f"Grade {rnd.randint(1, 12)}",
+                "roll_no": str(i + 1),
+                "address": f"{rnd.randint(1, 999)}, {rnd.choice(last)} Nagar, Main Road, Hyderabad",
+                "blood_group": rnd.choice(["A+", "B+", "O+", "AB-"]),
+            },
+        }
+
+
+def _peak_rss_bytes():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak if platform.system() == "Darwin" else peak * 1024
+
+
+def _generate_case(template, photos, n, workers, image_format, vector_text, prefetch, queue):
+    """Runs in a freshly spawned child so peak RSS belongs to this case only."""
+    try:
+        import django
+        from django.apps import apps
+        if not apps.ready:
+            django.setup()
+        timings = utils.RenderTimings()
+        with tempfile.TemporaryFile() as out:
+            start = time.perf_counter()
+            utils.generate_id_cards(synthetic_students(n, photos), template, paper="A4", workers=workers,
+                                    image_format=image_format, vector_text=vector_text, prefetch=prefetch,
+                                    output=out, timings=timings)
+            elapsed = time.perf_counter() - start
+            out.seek(0, os.SEEK_END)
+            pdf_bytes = out.tell()
+        child_rss = None
+        if resource is not None and workers > 1:
+            child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * (1 if platform.system() == "Darwin" else 1024)
+        queue.put({
+            "cards": n,
+            "seconds": round(elapsed, 3),
+            "cards_per_sec": round(n / elapsed, 2) if elapsed else None,
+            "pdf_bytes": pdf_bytes,
+            "peak_rss_bytes": _peak_rss_bytes(),
+            "peak_worker_rss_bytes": child_rss,
+            "phases": timings.summary()["phases"],
+            "counters": timings.summary()["counters"],
+        })
+    except Exception as e:
+        queue.put({"error": repr(e)})
+
+
+def run_in_child(target, *args):
+    # spawn, not fork: a forked child inherits the parent's high-water RSS (micro benchmarks,
+    # caches), which would then be reported as the case's peak
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=target, args=(*args, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def _rate(fn, number):
+    seconds = timeit.timeit(fn, number=number)
+    return {"runs": number, "seconds": round(seconds, 4), "per_sec": round(number / seconds, 2) if seconds else None}
+
+
+class Command(BaseCommand):
+    help = "Benchmark render_card_image, paste_photo_exact, compute_grid and generate_id_cards on synthetic data."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="100,1000,5000", help="Comma-separated card counts for generate_id_cards.")
+        parser.add_argument("--templates", default=",".join(TEMPLATE_KINDS),
+                            help=f"Comma-separated subset of {', '.join(TEMPLATE_KINDS)}.")
+        parser.add_argument("--workers", type=int, default=1)
+        parser.add_argument("--image-format", default="lossless", choices=utils.CARD_IMAGE_FORMATS)
+        parser.add_argument("--vector-text", action="store_true", help="Draw text fields as PDF text.")
+        parser.add_argument("--prefetch", type=int, default=utils.PHOTO_PREFETCH_DEPTH,
+                            help="Photo read-ahead depth for single-process runs (0 = off).")
+        parser.add_argument("--background-size", default="%dx%d" % DEFAULT_BACKGROUND_SIZE)
+        parser.add_argument("--photo-size", default="%dx%d" % DEFAULT_PHOTO_SIZE)
+        parser.add_argument("--micro-runs", type=int, default=20, help="Iterations for per-function benchmarks.")
+        parser.add_argument("--output", help="Write results as JSON to this path.")
+
+    def handle(self, *args, **opts):
+        try:
+            sizes = [int(s) for s in opts["sizes"].split(",") if s]
+            kinds = [k for k in opts["templates"].split(",") if k]
+            bg_size = tuple(int(v) for v in opts["background_size"].split("x"))
+            photo_size = tuple(int(v) for v in opts["photo_size"].split("x"))
+        except ValueError:
+            raise CommandError("--sizes, --background-size and --photo-size must be numeric.")
+        unknown = set(kinds) - set(TEMPLATE_KINDS)
+        if unknown:
+            raise CommandError(f"unknown template(s): {', '.join(sorted(unknown))}")
+
+        import PIL
+        import reportlab
+        results = {
+            "environment": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "pillow": PIL.__version__,
+                "reportlab": reportlab.Version,
+            },
+            "config": {
+                "sizes": sizes, "templates": kinds, "workers": opts["workers"],
+                "image_format": opts["image_format"], "vector_text": opts["vector_text"], "prefetch": opts["prefetch"],
+                "background_size": bg_size, "photo_size": photo_size,
+            },
+            "micro": {},
+            "generate": {},
+        }
+
+        workdir = tempfile.mkdtemp(prefix="idms-bench-")
+        try:
+            templates, photos = build_fixtures(workdir, bg_size, photo_size)
+            runs = opts["micro_runs"]
+
+            # ---------- per-function ----------
+            results["micro"]["compute_grid"] = _rate(
+                lambda: utils.compute_grid(*utils.PAPER_SIZES["A3"], 153.07, 243.78, 28.35, 8.5), 100000)
+
+            box = (200, 200, 800, 1000)
+            for shape in ("square", "circle", "hexagon"):
+                card = Image.new("RGBA", bg_size, "white")
+                results["micro"][f"paste_photo_exact[{shape}]"] = _rate(
+                    lambda: utils.paste_photo_exact(card, photos[0], *box, shape=shape), runs)
+
+            for kind in kinds:
+                tpl = templates[kind]
+                students = list(synthetic_students(runs, photos))
+                it = iter(students * 2)
+                utils.render_card_image(students[0], tpl)  # warm plan, fonts, background
+                results["micro"][f"render_card_image[{kind}]"] = _rate(
+                    lambda: utils.render_card_image(next(it), tpl), runs)
+            self.stdout.write(json.dumps(results["micro"], indent=2))
+
+            # ---------- end-to-end ----------
+            for kind in kinds:
+                for n in sizes:
+                    res = run_in_child(_generate_case, templates[kind], photos, n,
+                                       opts["workers"], opts["image_format"], opts["vector_text"], opts["prefetch"])
+                    results["generate"][f"{kind}/{n}"] = res
+                    if "error" in res:
+                        self.stderr.write(f"{kind}/{n}: {res['error']}")
+                    else:
+                        self.stdout.write(
+                            f"{kind:>8} {n:>6} cards  {res['cards_per_sec']:>8} cards/s  "
+                            f"{(res['peak_rss_bytes'] or 0) / 2**20:>8.1f} MiB peak  {res['pdf_bytes'] / 2**20:>9.1f} MiB pdf"
+                        )
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        if opts["output"]:
+            with open(opts["output"], "w") as fh:
+                json.dump(results, fh, indent=2)
+            self.stdout.write(f"wrote {opts['output']}")
@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from idms.jobs import claim_next_job, requeue_stale_jobs, run_job, worker_name
+
+
+class Command(BaseCommand):
+    help = "Claim and run queued ID-card generation jobs (GenerationJob) until stopped."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Drain the queue once and exit.")
+        parser.add_argument("--poll-interval", type=float, default=2.0,
+                            help="Seconds to sleep when the queue is empty.")
+        parser.add_argument("--stale-after", type=float, default=300.0,
+                            help="Requeue RUNNING jobs with no heartbeat for this many seconds.")
+
+    def handle(self, *args, **options):
+        name = worker_name()
+        self.stdout.write(f"generation worker {name} started")
+        while True:
+            requeued = requeue_stale_jobs(options["stale_after"])
+            if requeued:
+                self.stdout.write(f"requeued {requeued} stale job(s)")
+
+            job = claim_next_job(name)
+            if job is None:
+                if options["once"]:
+                    return
+                time.sleep(options["poll_interval"])
+                continue
+
+            self.stdout.write(f"job {job.id}: running")
+            job = run_job(job)
+            self.stdout.write(f"job {job.id}: {job.status} ({job.done}/{job.total})")
@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from idms.models import Student
+from idms.photos import claim_next_photo, process_photo, requeue_stale_photos
+
+
+class Command(BaseCommand):
+    help = "Normalize uploaded student photos (orientation, metadata, print size, thumbnail) until stopped."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Drain the queue once and exit.")
+        parser.add_argument("--poll-interval", type=float, default=2.0,
+                            help="Seconds to sleep when the queue is empty.")
+        parser.add_argument("--stale-after", type=float, default=300.0,
+                            help="Requeue photos stuck in PROCESSING for this many seconds.")
+        parser.add_argument("--backfill", action="store_true",
+                            help="First queue every student whose photo was never processed.")
+
+    def handle(self, *args, **options):
+        if options["backfill"]:
+            queued = (Student.objects.filter(photo_status="").exclude(photo="").exclude(photo__isnull=True)
+                      .update(photo_status="PENDING"))
+            self.stdout.write(f"queued {queued} photo(s) for processing")
+
+        self.stdout.write("photo worker started")
+        while True:
+            requeued = requeue_stale_photos(options["stale_after"])
+            if requeued:
+                self.stdout.write(f"requeued {requeued} stale photo(s)")
+
+            student = claim_next_photo()
+            if student is None:
+                if options["once"]:
+                    return
+                time.sleep(options["poll_interval"])
+                continue
+
+            result = process_photo(student)
+            self.stdout.write(f"student {student.id}: photo {result.lower()}")
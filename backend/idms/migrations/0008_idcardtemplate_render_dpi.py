@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:39
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('idms', '0007_generationjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='idcardtemplate',
+            name='render_dpi',
+            field=models.PositiveIntegerField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(72), django.core.validators.MaxValueValidator(1200)]),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('idms', '0009_student_updated_at_idcardtemplate_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='student',
+            name='photo_print',
+            field=models.ImageField(blank=True, null=True, upload_to='photos/print/'),
+        ),
+        migrations.AddField(
+            model_name='student',
+            name='photo_status',
+            field=models.CharField(blank=True, choices=[('', 'Not processed'), ('PENDING', 'Pending'), ('PROCESSING', 'Processing'), ('READY', 'Ready'), ('FAILED', 'Failed')], db_index=True, default='', max_length=12),
+        ),
+        migrations.AddField(
+            model_name='student',
+            name='photo_thumb',
+            field=models.ImageField(blank=True, null=True, upload_to='photos/thumbs/'),
+        ),
+    ]
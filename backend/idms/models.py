@@ -1,4 +1,5 @@
-from django.db import models
+from django.core.validators import MaxValueValidator, MinValueValidator
+from django.db import models, transaction
 from django.contrib.postgres.fields import ArrayField  # if Postgres; not required for JSONField
 from django.utils import timezone
 from datetime import timedelta
@@ -24,6 +25,10 @@ class PasswordResetToken(models.Model):
     def __str__(self):
         return f"PasswordResetToken(user={self.user_id}, token={self.token[:8]}..., used={self.used})"
 
+# accepted print resolutions for ID cards (template render_dpi and the generation dpi param);
+# 1200 dpi is already ~2.5k x 4k px per 54x86 mm card
+MIN_RENDER_DPI, MAX_RENDER_DPI = 72, 1200
+
 def default_expiry():
     return timezone.now() + timedelta(days=14)
 
@@ -43,7 +48,22 @@ class User(AbstractUser):
             self.role = "SUPER_ADMIN"
         super().save(*args, **kwargs)
 
-class FormTemplate(models.Model):
+class RetiresPublicLinks:
+    """Saving or deleting a row retires every cached public upload link (see idms.link_cache)."""
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        from .link_cache import bump_link_generation
+        transaction.on_commit(bump_link_generation, using=self._state.db)
+
+    def delete(self, *args, **kwargs):
+        from .link_cache import bump_link_generation
+        using = self._state.db
+        result = super().delete(*args, **kwargs)
+        transaction.on_commit(bump_link_generation, using=using)
+        return result
+
+class FormTemplate(RetiresPublicLinks, models.Model):
     """
     JSON-based form definition.
     Example fields JSON:
@@ -80,6 +100,48 @@ class UploadLink(models.Model):
         uses_ok = (self.max_uses is None) or (self.uses_count < self.max_uses)
         return time_ok and active_ok and uses_ok
 
+    def claim_use(self):
+        """
+        Count one submission against this link, atomically: a single conditional UPDATE
+        that only increments while the link is active, unexpired and under max_uses, so
+        concurrent submissions can neither lose increments nor overshoot the limit.
+        Returns False (and changes nothing) when the link can no longer be used.
+        """
+        claimed = (UploadLink.objects
+                   .filter(pk=self.pk, is_active=True, expires_at__gt=timezone.now())
+                   .filter(models.Q(max_uses__isnull=True) | models.Q(uses_count__lt=models.F("max_uses")))
+                   .update(uses_count=models.F("uses_count") + 1))
+        if claimed:
+            self.uses_count += 1  # approximate; other submissions may have landed too
+            if self.max_uses is not None:
+                # the cached payload's remaining uses are now out of date
+                self._forget_cached(self.token)
+        return bool(claimed)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # the token as stored, so a rotation can retire the old token's cached payload too
+        instance._stored_token = getattr(instance, "token", None)
+        return instance
+
+    def _forget_cached(self, *tokens):
+        # after commit: before it, a concurrent read could re-cache the old row
+        from .link_cache import forget_link
+        tokens = {t for t in tokens if t}
+        transaction.on_commit(lambda: [forget_link(t) for t in tokens], using=self._state.db)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self._forget_cached(getattr(self, "_stored_token", None), self.token)
+        self._stored_token = self.token
+
+    def delete(self, *args, **kwargs):
+        tokens = (getattr(self, "_stored_token", None), self.token)
+        result = super().delete(*args, **kwargs)
+        self._forget_cached(*tokens)
+        return result
+
     def __str__(self):
         return f"{self.school.name} - {self.classroom.class_name} ({self.token})"
 
@@ -88,7 +150,7 @@ class UploadLink(models.Model):
 def student_photo_upload_path(instance, filename):
     return f"photos/{instance.school.name}/{instance.full_name}/{filename}"
 
-class School(models.Model):
+class School(RetiresPublicLinks, models.Model):
     name = models.CharField(max_length=100)
     address = models.TextField()
     email = models.EmailField()
@@ -98,7 +160,7 @@ class School(models.Model):
     def __str__(self):
         return self.name
 
-class ClassRoom(models.Model):
+class ClassRoom(RetiresPublicLinks, models.Model):
     school = models.ForeignKey(School, on_delete=models.CASCADE, related_name='classes')
     class_name = models.CharField(max_length=50)  # e.g., "Grade 1", "Class A"
     section = models.CharField(max_length=10, blank=True, null=True)
@@ -117,10 +179,22 @@ class Student(models.Model):
     parent_email = models.EmailField(blank=True, null=True)
     parent_phone = models.CharField(max_length=20, blank=True, null=True)
     photo = models.ImageField(upload_to="photos/", blank=True, null=True)
+    # normalized derivatives of `photo` made by `manage.py run_photo_worker` (see idms.photos)
+    PHOTO_STATUS_CHOICES = (
+        ("", "Not processed"),
+        ("PENDING", "Pending"),
+        ("PROCESSING", "Processing"),
+        ("READY", "Ready"),
+        ("FAILED", "Failed"),
+    )
+    photo_print = models.ImageField(upload_to="photos/print/", blank=True, null=True)
+    photo_thumb = models.ImageField(upload_to="photos/thumbs/", blank=True, null=True)
+    photo_status = models.CharField(max_length=12, choices=PHOTO_STATUS_CHOICES, default="", blank=True, db_index=True)
     submitted = models.BooleanField(default=False)
     status = models.CharField(max_length=20, default="SUBMITTED")  # SUBMITTED / VERIFIED / APPROVED
     meta = models.JSONField(default=dict, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         constraints = [
@@ -143,6 +217,23 @@ class IdCardTemplate(models.Model):
     is_default = models.BooleanField(default=False)
     # store card size in mm for generation
     card_size_mm = models.JSONField(default=dict, blank=True)  # e.g. {"w":54,"h":86}
+    # print resolution for generated cards; empty = render at the background's native size
+    render_dpi = models.PositiveIntegerField(null=True, blank=True, validators=[
+        MinValueValidator(MIN_RENDER_DPI), MaxValueValidator(MAX_RENDER_DPI)])
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # drop any decoded background / compiled plan held for this template
+        from .utils import background_cache, evict_plan
+        background_cache.evict(self.pk)
+        evict_plan(self.pk)
+
+    def delete(self, *args, **kwargs):
+        from .utils import background_cache, evict_plan
+        background_cache.evict(self.pk)
+        evict_plan(self.pk)
+        return super().delete(*args, **kwargs)
 
     def __str__(self):
         return f"{self.school.name} - {self.name}"
@@ -167,4 +258,41 @@ class SubmissionIndex(models.Model):
         ]
 
     def __str__(self):
-        return f"{self.school_id}:{self.field_name}={self.field_value}"
\ No newline at end of file
+        return f"{self.school_id}:{self.field_name}={self.field_value}"
+
+class GenerationJob(models.Model):
+    """
+    A queued ID-card PDF run. Created by the API, claimed and executed by
+    `manage.py run_generation_jobs`, polled for progress, result downloaded when DONE.
+    """
+    STATUS_CHOICES = (
+        ("QUEUED", "Queued"),
+        ("RUNNING", "Running"),
+        ("DONE", "Done"),
+        ("FAILED", "Failed"),
+    )
+    school = models.ForeignKey("School", on_delete=models.CASCADE, related_name="generation_jobs")
+    classroom = models.ForeignKey("ClassRoom", on_delete=models.SET_NULL, null=True, blank=True, related_name="generation_jobs")
+    requested_by = models.ForeignKey("User", on_delete=models.SET_NULL, null=True, blank=True, related_name="generation_jobs")
+    params = models.JSONField(default=dict, blank=True)  # paper, card_size, workers, image_format, quality
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="QUEUED", db_index=True)
+    total = models.PositiveIntegerField(default=0)
+    done = models.PositiveIntegerField(default=0)
+    result = models.FileField(upload_to="generated/", blank=True, null=True)
+    error = models.TextField(blank=True, default="")
+    meta = models.JSONField(default=dict, blank=True)
+    worker = models.CharField(max_length=100, blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def eta_seconds(self):
+        """Seconds left at the current rate, or None before the first card is done."""
+        if self.status != "RUNNING" or not self.started_at or not self.done or not self.total:
+            return None
+        elapsed = (timezone.now() - self.started_at).total_seconds()
+        return max(0.0, elapsed / self.done * (self.total - self.done))
+
+    def __str__(self):
+        return f"GenerationJob {self.pk} ({self.status} {self.done}/{self.total})"
@@ -0,0 +1,155 @@
+# backend/idms/photos.py
+"""
+Normalized student photos.
+
+Parent uploads are kept as-is in Student.photo. `manage.py run_photo_worker` turns
+each new upload into an upright, metadata-free JPEG bounded to print resolution
+(Student.photo_print) and a small thumbnail for admin listings (Student.photo_thumb).
+Card rendering prefers photo_print, so it never decodes the full phone image.
+
+Like generation jobs, the queue is the table itself: photo_status PENDING rows are
+claimed with a conditional UPDATE, so several workers can run at once.
+"""
+import io
+import logging
+import os
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.utils import timezone
+from PIL import Image, ImageCms, ImageOps
+
+from .models import Student
+
+logger = logging.getLogger(__name__)
+
+# long side of the print derivative; 1600 px covers a 54x86 mm card photo box at 600 dpi
+PHOTO_PRINT_MAX_PX = getattr(settings, "IDCARD_PHOTO_PRINT_MAX_PX", 1600)
+PHOTO_THUMB_MAX_PX = getattr(settings, "IDCARD_PHOTO_THUMB_MAX_PX", 240)
+PHOTO_PRINT_QUALITY = 90
+PHOTO_THUMB_QUALITY = 80
+
+
+def normalize_photo(fh):
+    """
+    Auto-orient (EXIF), flatten and downscale an uploaded image.
+    Returns (print JPEG bytes, thumbnail JPEG bytes); EXIF and other metadata are dropped.
+    """
+    with Image.open(fh) as im:
+        # JPEG: let the decoder skip detail we'd throw away (never below the bound)
+        im.draft("RGB", (PHOTO_PRINT_MAX_PX, PHOTO_PRINT_MAX_PX))
+        icc = im.info.get("icc_profile")
+        img = ImageOps.exif_transpose(im)
+        if img.mode in ("RGBA", "LA", "P"):
+            img = img.convert("LA" if img.mode == "LA" else "RGBA")
+            flat = Image.new(img.mode[0] if img.mode == "LA" else "RGB", img.size, "white")
+            flat.paste(img, mask=img.getchannel("A"))
+            img = flat
+        if img.mode != "RGB":
+            # a grayscale or CMYK profile doesn't describe the RGB output: apply it instead
+            img = _to_srgb(img, icc)
+            icc = None
+
+    img.thumbnail((PHOTO_PRINT_MAX_PX, PHOTO_PRINT_MAX_PX), Image.LANCZOS)
+    # an RGB colour profile is kept (it is not metadata about the child); everything else is not copied
+    extra = {"icc_profile": icc} if icc else {}
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=PHOTO_PRINT_QUALITY, **extra)
+
+    thumb = img.copy()
+    thumb.thumbnail((PHOTO_THUMB_MAX_PX, PHOTO_THUMB_MAX_PX), Image.LANCZOS)
+    tout = io.BytesIO()
+    thumb.save(tout, format="JPEG", quality=PHOTO_THUMB_QUALITY, **extra)
+    return out.getvalue(), tout.getvalue()
+
+
+def _to_srgb(img, icc=None):
+    """`img` converted to RGB, through its ICC profile into sRGB when it has a usable one."""
+    if icc:
+        try:
+            return ImageCms.profileToProfile(img, ImageCms.ImageCmsProfile(io.BytesIO(icc)),
+                                             ImageCms.createProfile("sRGB"), outputMode="RGB")
+        except (ImageCms.PyCMSError, OSError, ValueError):
+            logger.info("ignoring unusable %s colour profile", img.mode)
+    return img.convert("RGB")
+
+
+def queue_photo(student_or_kwargs):
+    """Mark a (new or replaced) photo for processing and drop derivatives of the old one."""
+    target = student_or_kwargs
+    if isinstance(target, dict):
+        target.update(photo_status="PENDING", photo_print=None, photo_thumb=None)
+    else:
+        target.photo_status = "PENDING"
+        target.photo_print = None
+        target.photo_thumb = None
+    return target
+
+
+def discard_derivatives(student):
+    """Delete `student`'s current print/thumbnail files once the surrounding transaction commits."""
+    stale = [(f.storage, f.name) for f in (student.photo_print, student.photo_thumb) if f]
+
+    def delete():
+        for storage, name in stale:
+            try:
+                storage.delete(name)
+            except Exception:
+                logger.warning("could not delete stale photo derivative %s", name, exc_info=True)
+
+    if stale:
+        transaction.on_commit(delete)
+
+
+# ---------- worker ----------
+def claim_next_photo():
+    """Atomically move one PENDING student to PROCESSING and return it (None if none are queued)."""
+    while True:
+        student_id = (Student.objects.filter(photo_status="PENDING")
+                      .order_by("updated_at", "id").values_list("id", flat=True).first())
+        if student_id is None:
+            return None
+        claimed = Student.objects.filter(id=student_id, photo_status="PENDING").update(
+            photo_status="PROCESSING", updated_at=timezone.now(),
+        )
+        if claimed:
+            return Student.objects.get(id=student_id)
+
+
+def requeue_stale_photos(stale_after_seconds):
+    """Put PROCESSING photos whose worker died back on the queue."""
+    cutoff = timezone.now() - timezone.timedelta(seconds=stale_after_seconds)
+    return Student.objects.filter(photo_status="PROCESSING", updated_at__lt=cutoff).update(photo_status="PENDING")
+
+
+def process_photo(student):
+    """Build the derivatives for a claimed student; returns the final photo_status."""
+    original = student.photo.name if student.photo else ""
+    try:
+        if not original:
+            raise ValueError("student has no photo")
+        with student.photo.open("rb") as fh:
+            print_bytes, thumb_bytes = normalize_photo(fh)
+        base = os.path.splitext(os.path.basename(original))[0]
+        storage = student.photo_print.storage
+        print_name = storage.save(student.photo_print.field.generate_filename(student, f"{base}.jpg"),
+                                  ContentFile(print_bytes))
+        thumb_name = storage.save(student.photo_thumb.field.generate_filename(student, f"{base}.jpg"),
+                                  ContentFile(thumb_bytes))
+    except Exception:
+        logger.exception("photo normalization failed for student %s", student.pk)
+        Student.objects.filter(id=student.id, photo_status="PROCESSING").update(
+            photo_status="FAILED", updated_at=timezone.now(),
+        )
+        return "FAILED"
+
+    # only if the photo wasn't replaced while we worked (a replacement re-queues itself)
+    done = Student.objects.filter(id=student.id, photo=original, photo_status="PROCESSING").update(
+        photo_print=print_name, photo_thumb=thumb_name, photo_status="READY", updated_at=timezone.now(),
+    )
+    if not done:
+        storage.delete(print_name)
+        storage.delete(thumb_name)
+        return "STALE"
+    return "READY"
@@ -0,0 +1,227 @@
+# backend/idms/previews.py
+"""
+Single-card JPEG previews for the template editor, with HTTP validators.
+
+A preview's ETag is the rendered-card cache key (template fields + background file +
+render size + the student's render inputs), so an unchanged preview is answered
+with a 304, or with the cached JPEG, without rendering.
+
+Draft previews (`scale` / `max_px`) render a scaled-down card with scaled boxes and
+fonts, and may carry unsaved `fields` overrides from the editor. Contact sheets lay
+many draft thumbnails out on one image (or a low-res PDF) for QA before printing.
+"""
+import io
+import math
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+from PIL import Image, ImageDraw
+
+from .card_cache import RenderedCardCache, get_card_cache
+from .utils import (background_cache, card_pixel_size, compile_template, encode_card, generate_id_cards,
+                    load_font, render_card_image)
+
+PREVIEW_JPEG_QUALITY = getattr(settings, "IDCARD_PREVIEW_JPEG_QUALITY", 90)
+DRAFT_JPEG_QUALITY = getattr(settings, "IDCARD_PREVIEW_DRAFT_JPEG_QUALITY", 75)
+MIN_DRAFT_PX = 32
+# contact sheets: cards per page, thumbnail long side, PDF raster resolution
+CONTACT_SHEET_PER_PAGE = getattr(settings, "IDCARD_CONTACT_SHEET_PER_PAGE", 60)
+CONTACT_SHEET_MAX_PER_PAGE = 200
+CONTACT_SHEET_THUMB_PX = getattr(settings, "IDCARD_CONTACT_SHEET_THUMB_PX", 240)
+CONTACT_SHEET_MAX_THUMB_PX = 600
+CONTACT_SHEET_PDF_DPI = getattr(settings, "IDCARD_CONTACT_SHEET_PDF_DPI", 100)
+CONTACT_SHEET_LABEL_FONT = "dejavu/DejaVuSans.ttf"
+
+
+class PreviewError(Exception):
+    """Bad preview parameters; the message is safe to show to the client."""
+
+
+def draft_size(template, scale=None, max_px=None):
+    """
+    Pixel size of a draft preview: the full render size (render_dpi or native)
+    multiplied by `scale` and/or shrunk so its longer side is at most `max_px`.
+    Never upscales; returns None when the full size already fits.
+    """
+    dpi = getattr(template, "render_dpi", None)
+    full = card_pixel_size(template, dpi) if dpi else background_cache.native_size(template)
+    factor = 1.0
+    if scale:
+        factor = min(factor, scale)
+    if max_px:
+        factor = min(factor, max_px / max(full))
+    if factor >= 1.0:
+        return None
+    return (max(1, round(full[0] * factor)), max(1, round(full[1] * factor)))
+
+
+def apply_preview_params(template, query, body=None):
+    """
+    Read draft options from the request and apply unsaved `fields` overrides to
+    `template` in memory (never saved). Returns the draft pixel size or None.
+    Raises PreviewError.
+    """
+    body = body or {}
+
+    def param(name):
+        value = body.get(name)
+        return value if value not in (None, "") else query.get(name)
+
+    scale = max_px = None
+    try:
+        if param("scale") not in (None, ""):
+            scale = float(param("scale"))
+        if param("max_px") not in (None, ""):
+            max_px = int(param("max_px"))
+    except (TypeError, ValueError):
+        raise PreviewError("scale must be a number and max_px an integer.")
+    if scale is not None and not 0 < scale <= 1:
+        raise PreviewError("scale must be in (0, 1].")
+    if max_px is not None and max_px < MIN_DRAFT_PX:
+        raise PreviewError(f"max_px must be at least {MIN_DRAFT_PX}.")
+
+    overrides = body.get("fields")
+    if overrides is not None:
+        if not isinstance(overrides, dict):
+            raise PreviewError("fields must be an object of field name -> config.")
+        # each given field replaces the saved config of that field
+        template.fields = {**(template.fields or {}), **overrides}
+
+    if scale is None and max_px is None:
+        return None
+    return draft_size(template, scale, max_px)
+
+
+def preview_key(student, template, plan=None, quality=PREVIEW_JPEG_QUALITY):
+    """Content digest of the preview `student` gets with `template` (used as ETag and cache key)."""
+    plan = plan or compile_template(template)
+    run_key = RenderedCardCache.run_key(template, plan, "jpeg", quality)
+    return RenderedCardCache.card_key(run_key, plan.fingerprint(student))
+
+
+def preview_last_modified(student, template):
+    """Newest of the template / student row versions as a timestamp, or None."""
+    stamps = [getattr(obj, "updated_at", None) for obj in (template, student)]
+    stamps = [s for s in stamps if s is not None]
+    return int(max(stamps).timestamp()) if stamps else None
+
+
+def render_preview_jpeg(student, template, key=None, plan=None, quality=PREVIEW_JPEG_QUALITY, use_cache=True):
+    """JPEG bytes of the preview, served from the rendered-card cache when possible."""
+    plan = plan or compile_template(template)
+    key = key or preview_key(student, template, plan, quality)
+    cache = get_card_cache() if use_cache else None
+    data = cache.get(key, "jpeg") if cache is not None else None
+    if data is None:
+        img = render_card_image(student, template, plan=plan)
+        data = encode_card(img, "jpeg", quality)
+        if cache is not None:
+            cache.put(key, data, "jpeg")
+    return data
+
+
+def preview_response(request, student, template, size=None):
+    """
+    image/jpeg response for the preview (a draft when `size` is given).
+    GETs carry ETag / Last-Modified and get a 304 when the client's copy is current;
+    POSTs (unsaved field overrides) are rendered fresh and not stored.
+    """
+    draft = size is not None
+    plan = compile_template(template, size=size, draft=draft)
+    quality = DRAFT_JPEG_QUALITY if draft else PREVIEW_JPEG_QUALITY
+    key = preview_key(student, template, plan, quality)
+
+    if request.method not in ("GET", "HEAD"):
+        response = HttpResponse(render_preview_jpeg(student, template, key, plan, quality, use_cache=False),
+                                content_type="image/jpeg")
+        patch_cache_control(response, no_store=True)
+        return response
+
+    last_modified = preview_last_modified(student, template)
+    response = get_conditional_response(request, etag=quote_etag(key), last_modified=last_modified)
+    if response is None:
+        response = HttpResponse(render_preview_jpeg(student, template, key, plan, quality), content_type="image/jpeg")
+    response.headers["ETag"] = quote_etag(key)
+    if last_modified is not None:
+        response.headers["Last-Modified"] = http_date(last_modified)
+    # previews are per-user (auth required): let the browser keep them, but always revalidate
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+# ---------- contact sheets ----------
+def parse_contact_sheet_params(template, query):
+    """
+    Students and layout options for a contact sheet. `student_ids` ("1,2,3") picks
+    students of the template's school in any status; otherwise `classroom` selects its
+    VERIFIED students (what generate_ids would print). Raises PreviewError.
+    """
+    from .models import Student
+
+    qs = Student.objects.filter(school_id=template.school_id).order_by("id")
+    try:
+        if query.get("student_ids"):
+            ids = [int(v) for v in str(query.get("student_ids")).split(",") if v.strip()]
+            qs = qs.filter(id__in=ids)
+        elif query.get("classroom"):
+            qs = qs.filter(classroom_id=int(query.get("classroom")), status="VERIFIED")
+        else:
+            raise PreviewError("classroom or student_ids is required.")
+        page = max(1, int(query.get("page") or 1))
+        per_page = max(1, min(CONTACT_SHEET_MAX_PER_PAGE, int(query.get("per_page") or CONTACT_SHEET_PER_PAGE)))
+        thumb_px = max(MIN_DRAFT_PX, int(query.get("thumb_px") or CONTACT_SHEET_THUMB_PX))
+        cols = int(query.get("cols")) if query.get("cols") else None
+    except (TypeError, ValueError):
+        raise PreviewError("classroom, student_ids, page, per_page, thumb_px and cols must be integers.")
+    if thumb_px > CONTACT_SHEET_MAX_THUMB_PX:
+        raise PreviewError(f"thumb_px must be at most {CONTACT_SHEET_MAX_THUMB_PX}.")
+    # not "format": DRF reserves that query param for renderer selection
+    fmt = query.get("output") or "jpeg"
+    if fmt not in ("jpeg", "pdf"):
+        raise PreviewError("output must be jpeg or pdf.")
+    return {"students": qs, "page": page, "per_page": per_page, "thumb_px": thumb_px, "cols": cols,
+            "format": fmt, "paper": query.get("paper") or "A4"}
+
+
+def contact_sheet_image(students, template, thumb_px=CONTACT_SHEET_THUMB_PX, cols=None, labels=True):
+    """
+    One RGB image with a draft thumbnail per student, in a grid (default: roughly
+    square). Every card is drawn on a copy of the same resampled background.
+    """
+    students = list(students)
+    size = draft_size(template, max_px=thumb_px)
+    plan = compile_template(template, size=size, draft=True)
+    thumbs = [render_card_image(st, template, plan=plan) for st in students]
+    if not thumbs:
+        return Image.new("RGB", (thumb_px, thumb_px), "white")
+
+    tw, th = thumbs[0].size
+    cols = max(1, min(cols or math.ceil(math.sqrt(len(thumbs))), len(thumbs)))
+    rows = math.ceil(len(thumbs) / cols)
+    gap = max(8, tw // 20)
+    font = load_font(CONTACT_SHEET_LABEL_FONT, 12)
+    label_h = 18 if labels else 0
+    sheet = Image.new("RGB", (gap + cols * (tw + gap), gap + rows * (th + label_h + gap)), (230, 230, 230))
+    draw = ImageDraw.Draw(sheet)
+    for i, (st, thumb) in enumerate(zip(students, thumbs)):
+        x = gap + (i % cols) * (tw + gap)
+        y = gap + (i // cols) * (th + label_h + gap)
+        sheet.paste(thumb, (x, y))
+        if labels:
+            text = f"#{st.pk} {st}" if getattr(st, "pk", None) else str(st)
+            while text and draw.textlength(text, font=font) > tw:
+                text = text[:-1]
+            draw.text((x, y + th + 3), text, fill=(40, 40, 40), font=font)
+    return sheet
+
+
+def contact_sheet_jpeg(students, template, thumb_px=CONTACT_SHEET_THUMB_PX, cols=None):
+    return encode_card(contact_sheet_image(students, template, thumb_px, cols), "jpeg", DRAFT_JPEG_QUALITY)
+
+
+def contact_sheet_pdf(students, template, paper="A4", dpi=CONTACT_SHEET_PDF_DPI):
+    """Print-layout PDF of all cards at a low raster resolution, for proofing."""
+    return generate_id_cards(students, template, paper=paper, image_format="jpeg",
+                             jpeg_quality=DRAFT_JPEG_QUALITY, dpi=dpi, draft=True, output=io.BytesIO())
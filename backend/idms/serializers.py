@@ -1,5 +1,6 @@
 from rest_framework import serializers
-from .models import School, ClassRoom, Student, UploadLink, FormTemplate, User, IdCardTemplate
+from .models import School, ClassRoom, Student, UploadLink, FormTemplate, User, IdCardTemplate, GenerationJob
+from .photos import discard_derivatives, queue_photo
 
 
 class SchoolSerializer(serializers.ModelSerializer):
@@ -145,13 +146,28 @@ class StudentSerializer(serializers.ModelSerializer):
         fields = [
             "id", "school", "classroom",
             "full_name", "fatherName", "dob", "gender",
-            "photo",
+            "photo", "photo_thumb", "photo_print", "photo_status",
             "parent_email", "parent_phone",
             "status",          # <-- include this
             "meta",            # <-- include this (so fatherName shows in UI under meta)
             "submitted", "created_at"
         ]
-        read_only_fields = ["submitted", "created_at"]
+        read_only_fields = ["submitted", "created_at", "photo_thumb", "photo_print", "photo_status"]
+
+    def create(self, validated_data):
+        if validated_data.get("photo"):
+            queue_photo(validated_data)
+        return super().create(validated_data)
+
+    def update(self, instance, validated_data):
+        if "photo" in validated_data:
+            # derivatives of the old photo are replaced (or dropped): remove their files
+            discard_derivatives(instance)
+            if validated_data["photo"]:
+                queue_photo(validated_data)
+            else:
+                validated_data.update(photo_status="", photo_print=None, photo_thumb=None)
+        return super().update(instance, validated_data)
 
 class ParentSubmissionSerializer(serializers.Serializer):
     # full_name = serializers.CharField(max_length=100)
@@ -167,7 +183,7 @@ class IdCardTemplateSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = IdCardTemplate
-        fields = ["id","school","name","background","background_url","fields","is_default","created_at","card_size_mm"]
+        fields = ["id","school","name","background","background_url","fields","is_default","created_at","card_size_mm","render_dpi"]
 
 
     def get_background_url(self, obj):
@@ -179,6 +195,19 @@ class IdCardTemplateSerializer(serializers.ModelSerializer):
                 return obj.background.url
         return None
     
+class GenerationJobSerializer(serializers.ModelSerializer):
+    eta_seconds = serializers.SerializerMethodField()
+
+    class Meta:
+        model = GenerationJob
+        fields = ["id", "school", "classroom", "params", "status", "total", "done", "eta_seconds",
+                  "error", "meta", "created_at", "started_at", "finished_at"]
+        read_only_fields = fields
+
+    def get_eta_seconds(self, obj):
+        eta = obj.eta_seconds()
+        return None if eta is None else round(eta, 1)
+
 class ChangePasswordSerializer(serializers.Serializer):
     """
     Accepts a few common payload shapes used by dj-rest-auth / djoser / custom endpoints:
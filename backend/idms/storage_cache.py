@@ -0,0 +1,189 @@
+# backend/idms/storage_cache.py
+"""
+Local disk cache of media files (student photos, template backgrounds) for rendering.
+
+Media is read through the Django storage API, so it works with the S3 bucket
+configured in settings as well as with local MEDIA_ROOT. Files on a filesystem
+storage are used in place. Files on a remote storage are downloaded once into
+IDCARD_STORAGE_CACHE_DIR, keyed by (storage, name, version), where the version is
+the object's ETag and size. A second generation run of the same class reads
+everything from local disk; a re-uploaded photo has a new version and is fetched again.
+
+Versions of remote objects are remembered for IDCARD_STORAGE_VERSION_TTL seconds,
+so a batch run costs one HEAD per file at most, not one per card.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage, Storage
+
+from .disk_cache import DiskLRUCache
+
+STORAGE_CACHE_MAX_BYTES = 2 * 1024 ** 3
+STORAGE_VERSION_TTL = 60.0
+
+
+def is_local(storage, name):
+    """True when `storage` can hand out a filesystem path for `name` (no copy needed)."""
+    try:
+        storage.path(name)
+    except NotImplementedError:
+        return False
+    return True
+
+
+def object_version(storage, name):
+    """
+    Cheap identity of a stored file that changes whenever its content does:
+    (etag, size) on S3 (one HEAD request), (mtime, size) through the generic storage API.
+    """
+    bucket = getattr(storage, "bucket", None)
+    if bucket is not None:
+        # django-storages S3: the object key is the storage location joined with the name
+        from storages.utils import clean_name, safe_join
+        obj = bucket.Object(safe_join(storage.location, clean_name(name)))
+        return (obj.e_tag.strip('"'), obj.content_length)
+    return (storage.get_modified_time(name).timestamp(), storage.size(name))
+
+
+class StorageFileCache(DiskLRUCache):
+    """
+    Local copies of remote media files, one per (storage, name, version), plus the
+    versions themselves remembered in memory for `version_ttl` seconds.
+    """
+    def __init__(self, root, max_bytes=STORAGE_CACHE_MAX_BYTES, version_ttl=STORAGE_VERSION_TTL):
+        super().__init__(root, max_bytes)
+        self.version_ttl = version_ttl
+        self._versions = {}  # (storage id, name) -> (version, checked at)
+
+    def __getstate__(self):
+        return {**super().__getstate__(), "version_ttl": self.version_ttl}
+
+    @staticmethod
+    def storage_id(storage):
+        cls = type(storage)
+        where = getattr(storage, "bucket_name", None) or getattr(storage, "location", "")
+        return f"{cls.__module__}.{cls.__qualname__}:{where}"
+
+    # ---------- lookups ----------
+    def version(self, storage, name):
+        """object_version() of a remote file, remembered for version_ttl seconds."""
+        key = (self.storage_id(storage), name)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._versions.get(key)
+        if cached is not None and now - cached[1] < self.version_ttl:
+            return cached[0]
+        version = object_version(storage, name)
+        with self._lock:
+            self._versions[key] = (version, now)
+        return version
+
+    def _path(self, storage, name, version):
+        digest = hashlib.sha1(repr((self.storage_id(storage), name, version)).encode()).hexdigest()
+        ext = os.path.splitext(name)[1].lower()[:8]
+        return os.path.join(self.root, digest[:2], digest + ext)
+
+    def local_path(self, storage, name):
+        """Filesystem path holding the current content of `name`, downloading it on a miss."""
+        path = self._path(storage, name, self.version(storage, name))
+        if self.touch(path):  # bumps recency for LRU
+            self._count(hit=True)
+            return path
+
+        self._count(hit=False)
+
+        def download(fh):
+            with storage.open(name, "rb") as src:
+                shutil.copyfileobj(src, fh, 1024 * 1024)
+
+        if not self.write(path, download):
+            raise OSError(f"could not cache {name!r} under {self.root}")
+        return path
+
+    def forget(self, storage, name):
+        """Drop the remembered version of `name` (e.g. right after re-uploading it)."""
+        with self._lock:
+            self._versions.pop((self.storage_id(storage), name), None)
+
+
+_default_cache = None
+
+
+def get_storage_cache():
+    """The process-wide cache configured by IDCARD_STORAGE_CACHE_DIR / _MAX_BYTES / IDCARD_STORAGE_VERSION_TTL."""
+    global _default_cache
+    root = getattr(settings, "IDCARD_STORAGE_CACHE_DIR", None) or os.path.join(tempfile.gettempdir(), "idms-media")
+    if _default_cache is None or _default_cache.root != str(root):
+        _default_cache = StorageFileCache(
+            root,
+            getattr(settings, "IDCARD_STORAGE_CACHE_MAX_BYTES", STORAGE_CACHE_MAX_BYTES),
+            getattr(settings, "IDCARD_STORAGE_VERSION_TTL", STORAGE_VERSION_TTL),
+        )
+    return _default_cache
+
+
+def local_media_path(fieldfile):
+    """
+    Filesystem path to read a FieldFile (or anything with .storage/.name, or just .path)
+    for rendering. Local storages return their own path; remote ones go through the cache.
+    """
+    storage = getattr(fieldfile, "storage", None)
+    name = getattr(fieldfile, "name", None)
+    if storage is None or not name:
+        return fieldfile.path
+    if is_local(storage, name):
+        return storage.path(name)
+    return get_storage_cache().local_path(storage, name)
+
+
+def media_version(fieldfile):
+    """(mtime/etag, size) identity of a FieldFile, without downloading it. Raises OSError & co."""
+    storage = getattr(fieldfile, "storage", None)
+    name = getattr(fieldfile, "name", None)
+    if storage is None or not name or is_local(storage, name):
+        st = os.stat(fieldfile.path)
+        return (st.st_mtime_ns, st.st_size)
+    return get_storage_cache().version(storage, name)
+
+
+class BucketStandInStorage(Storage):
+    """
+    A filesystem-backed stand-in for the S3 bucket: files live under MEDIA_ROOT, but like
+    S3 it has no path(). Point STORAGES["default"] at it in a dev settings file to exercise
+    the remote (download + disk cache) code path without a bucket.
+    """
+    def __init__(self, location=None, base_url=None):
+        self._fs = FileSystemStorage(location, base_url)
+
+    @property
+    def location(self):
+        return self._fs.location
+
+    def _open(self, name, mode="rb"):
+        return self._fs._open(name, mode)
+
+    def _save(self, name, content):
+        return self._fs._save(name, content)
+
+    def delete(self, name):
+        self._fs.delete(name)
+
+    def exists(self, name):
+        return self._fs.exists(name)
+
+    def listdir(self, path):
+        return self._fs.listdir(path)
+
+    def size(self, name):
+        return self._fs.size(name)
+
+    def url(self, name):
+        return self._fs.url(name)
+
+    def get_modified_time(self, name):
+        return self._fs.get_modified_time(name)
@@ -1,3 +1,394 @@
-from django.test import TestCase
+import io
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import uuid
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connections
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from PIL import Image, ImageCms
+from rest_framework.test import APIClient
+
+from .card_cache import RenderedCardCache
+from .jobs import (claim_next_job, parse_generation_params, requeue_stale_jobs, run_generation, run_job,
+                   stream_students, students_for)
+from .models import ClassRoom, FormTemplate, GenerationJob, IdCardTemplate, School, Student, UploadLink
+from .photos import normalize_photo
+from .previews import PreviewError, parse_contact_sheet_params
+from .storage_cache import get_storage_cache
+from .utils import RENDER_VERSION, background_cache, compile_template, iter_card_images, render_card_image
+
+
+def png_file(size, color, name="x.png"):
+    buf = io.BytesIO()
+    Image.new("RGB", size, color).save(buf, format="PNG")
+    return ContentFile(buf.getvalue(), name=name)
+
+
+class NormalizePhotoTests(SimpleTestCase):
+    SRGB = ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB")).tobytes()
+
+    def thumbnail(self, mode, color):
+        buf = io.BytesIO()
+        Image.new(mode, (50, 50), color).save(buf, format="JPEG", icc_profile=self.SRGB)
+        buf.seek(0)
+        return Image.open(io.BytesIO(normalize_photo(buf)[1]))
+
+    def test_rgb_keeps_its_profile(self):
+        thumb = self.thumbnail("RGB", (200, 30, 30))
+        self.assertEqual(thumb.info.get("icc_profile"), self.SRGB)
+
+    def test_cmyk_and_grayscale_profiles_are_not_copied_onto_rgb(self):
+        for mode, color, expected in (("CMYK", (0, 255, 255, 0), (255, 0, 0)), ("L", 128, (128, 128, 128))):
+            with self.subTest(mode=mode):
+                thumb = self.thumbnail(mode, color)
+                self.assertEqual(thumb.mode, "RGB")
+                self.assertIsNone(thumb.info.get("icc_profile"))
+                for got, want in zip(thumb.getpixel((25, 25)), expected):
+                    self.assertAlmostEqual(got, want, delta=3)
+
+
+class RemoteStorageRenderTests(TestCase):
+    """Rendering reads photos/backgrounds through a storage without path(), like S3."""
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        storages = {
+            "default": {"BACKEND": "idms.storage_cache.BucketStandInStorage", "OPTIONS": {"location": media}},
+            "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+        }
+        overrides = override_settings(STORAGES=storages, IDCARD_STORAGE_CACHE_DIR=cache_dir, IDCARD_CACHE_DIR=None)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        background_cache.clear()
+
+        school = School.objects.create(name="S", address="a", email="s@example.com", phone="1")
+        classroom = ClassRoom.objects.create(school=school, class_name="5", section="A", total_students=1)
+        self.template = IdCardTemplate(school=school, name="T", card_size_mm={"w": 54, "h": 86},
+                                       fields={"photo": {"x": 50, "y": 100, "width": 200, "height": 250}})
+        self.template.background.save("bg.png", png_file((300, 480), "white"), save=False)
+        self.template.save()
+        self.student = Student(school=school, classroom=classroom, full_name="Kid")
+        self.student.photo.save("kid.png", png_file((200, 250), (200, 30, 30)), save=False)
+        self.student.save()
+
+    def test_renders_through_the_storage_cache(self):
+        with self.assertRaises(NotImplementedError):
+            self.student.photo.path
+        cache = get_storage_cache()
+
+        card = render_card_image(self.student, self.template)
+        self.assertEqual(card.size, (300, 480))
+        self.assertEqual(card.getpixel((150, 225)), (200, 30, 30))
+        self.assertEqual((cache.hits, cache.misses), (0, 2))  # photo + background downloaded
+
+        background_cache.clear()
+        render_card_image(self.student, self.template)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))  # both served from local disk
+
+
+class LocalMediaTestCase(TestCase):
+    """A school, class and template with media in a throwaway MEDIA_ROOT."""
+
+    def setUp(self):
+        self.media = media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        overrides = override_settings(MEDIA_ROOT=media, IDCARD_CACHE_DIR=None)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        background_cache.clear()
+
+        self.school = School.objects.create(name="S", address="a", email="s@example.com", phone="1")
+        self.classroom = ClassRoom.objects.create(school=self.school, class_name="5", section="A", total_students=1)
+        self.template = IdCardTemplate(school=self.school, name="T", card_size_mm={"w": 54, "h": 86}, fields={
+            "photo": {"x": 50, "y": 60, "width": 150, "height": 200},
+            "full_name": {"x": 20, "y": 300, "width": 260, "height": 30},
+        })
+        self.template.background.save("bg.png", png_file((300, 480), "white"), save=False)
+        self.template.save()
+        self.student = Student(school=self.school, classroom=self.classroom, full_name="Kid")
+        self.student.photo.save("kid.png", png_file((150, 200), (200, 30, 30)), save=False)
+        self.student.save()
+
+
+class RenderPlanTests(LocalMediaTestCase):
+    def test_resized_plan_follows_a_background_reupload_from_another_process(self):
+        self.template.render_dpi = 300
+        self.template.save()
+        photo = compile_template(self.template).fields[0]
+        self.assertEqual((photo.x, photo.y, photo.w, photo.h), (106, 127, 319, 423))
+
+        # another process uploads a background twice the size: this process's plan is not evicted
+        name = self.template.background.storage.save("bg2.png", png_file((600, 960), "white"))
+        IdCardTemplate.objects.filter(pk=self.template.pk).update(background=name)
+        template = IdCardTemplate.objects.get(pk=self.template.pk)
+
+        photo = compile_template(template).fields[0]
+        self.assertEqual((photo.x, photo.y, photo.w, photo.h), (53, 64, 160, 212))
+
+
+class RenderedCardCacheTests(LocalMediaTestCase):
+    def setUp(self):
+        super().setUp()
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        self.cache = RenderedCardCache(root)
+
+    def assertRenders(self, hit):
+        """One generation run of the student: a cache hit, or a miss that fills the cache."""
+        before = (self.cache.hits, self.cache.misses)
+        student = Student.objects.get(pk=self.student.pk)
+        template = IdCardTemplate.objects.get(pk=self.template.pk)
+        list(iter_card_images([student], template, image_format="jpeg", card_cache=self.cache))
+        self.assertEqual((self.cache.hits - before[0], self.cache.misses - before[1]), (1, 0) if hit else (0, 1))
+
+    def test_unchanged_regeneration_hits(self):
+        self.assertRenders(hit=False)
+        self.assertRenders(hit=True)
+
+    def test_text_change_misses(self):
+        self.assertRenders(hit=False)
+        self.student.full_name = "Kid Jr"
+        self.student.save()
+        self.assertRenders(hit=False)
+        self.assertRenders(hit=True)
+
+    def test_photo_replacement_misses(self):
+        self.assertRenders(hit=False)
+        self.student.photo.save("kid.png", png_file((150, 200), (30, 30, 200)))
+        self.assertRenders(hit=False)
+        # the normalized print derivative is what gets rendered once it exists
+        self.student.photo_print.save("kid.jpg", png_file((150, 200), (30, 200, 30), "kid.jpg"))
+        self.assertRenders(hit=False)
+        self.assertRenders(hit=True)
+
+    def test_background_reupload_misses(self):
+        self.assertRenders(hit=False)
+        self.template.background.save("bg.png", png_file((300, 480), "yellow"))
+        self.assertRenders(hit=False)
+        self.assertRenders(hit=True)
+
+    def test_render_version_bump_misses(self):
+        self.assertRenders(hit=False)
+        with mock.patch("idms.card_cache.RENDER_VERSION", RENDER_VERSION + 1):
+            self.assertRenders(hit=False)
+            self.assertRenders(hit=True)
+
+
+class ContactSheetParamsTests(LocalMediaTestCase):
+    def test_thumb_px_is_bounded(self):
+        opts = parse_contact_sheet_params(self.template, {"classroom": str(self.classroom.pk), "thumb_px": "600"})
+        self.assertEqual(opts["thumb_px"], 600)
+        with self.assertRaisesMessage(PreviewError, "thumb_px must be at most 600"):
+            parse_contact_sheet_params(self.template, {"classroom": str(self.classroom.pk), "thumb_px": "100000"})
+
+
+class GenerationJobTests(LocalMediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.template.is_default = True
+        self.template.save()
+        Student.objects.filter(pk=self.student.pk).update(status="VERIFIED")
+        for name in ("Ann", "Bob"):
+            Student.objects.create(school=self.school, classroom=self.classroom, full_name=name, status="VERIFIED")
+        params = parse_generation_params({"school": self.school.pk, "classroom": self.classroom.pk})
+        self.job = GenerationJob.objects.create(school=self.school, classroom=self.classroom, params=params)
+
+    def test_run_reports_progress(self):
+        job = claim_next_job("w1")
+        self.assertEqual((job.pk, job.status, job.worker), (self.job.pk, "RUNNING", "w1"))
+        self.assertIsNone(claim_next_job("w2"))
+
+        seen = []
+        def progress_rows(*args, progress, **kwargs):
+            def spy(count):
+                progress(count)
+                seen.append(GenerationJob.objects.values_list("done", "total").get(pk=job.pk))
+            return run_generation(*args, progress=spy, **kwargs)
+
+        with mock.patch("idms.jobs.JOB_PROGRESS_INTERVAL_SECONDS", 0), \
+                mock.patch("idms.jobs.run_generation", side_effect=progress_rows):
+            job = run_job(job)
+        self.assertEqual(seen, [(1, 3), (2, 3), (3, 3)])
+        self.assertEqual((job.status, job.done, job.total, job.error), ("DONE", 3, 3, ""))
+        self.assertTrue(job.result.read().startswith(b"%PDF"))
+        self.assertIsNone(job.eta_seconds())
+
+    def test_streamed_students_load_only_rendered_columns(self):
+        self.template.render_dpi = 300
+        self.template.save()
+        with mock.patch.object(background_cache, "native_size", side_effect=AssertionError("background opened")):
+            students = list(stream_students(students_for(self.job.params), self.template))
+        self.assertEqual(len(students), 3)
+        deferred = students[0].get_deferred_fields()
+        self.assertTrue({"parent_phone", "status"} <= deferred)
+        self.assertFalse({"full_name", "photo", "photo_print", "meta"} & deferred)
+
+    def test_eta_at_the_current_rate(self):
+        job = GenerationJob(status="RUNNING", started_at=timezone.now() - timezone.timedelta(seconds=30),
+                            done=3, total=9)
+        self.assertAlmostEqual(job.eta_seconds(), 60, delta=1)
+        job.done = 0
+        self.assertIsNone(job.eta_seconds())
+
+    def test_requeued_job_is_not_finished_by_its_old_worker(self):
+        job = claim_next_job("w1")
+
+        def stalled_run(params, output, **kwargs):
+            output.write(b"%PDF-1.3 stale")
+            # w1 missed its heartbeats: the job is requeued and claimed by w2 meanwhile
+            GenerationJob.objects.filter(pk=job.pk).update(
+                heartbeat_at=timezone.now() - timezone.timedelta(minutes=10))
+            self.assertEqual(requeue_stale_jobs(60), 1)
+            self.assertEqual(claim_next_job("w2").pk, job.pk)
+            return output
+
+        with mock.patch("idms.jobs.run_generation", side_effect=stalled_run):
+            run_job(job)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.worker, job.result.name or None), ("RUNNING", "w2", None))
+        self.assertEqual(os.listdir(os.path.join(self.media, "generated")), [])  # w1's upload removed
+
+
+class ConcurrentJobClaimTests(TransactionTestCase):
+    def test_only_one_worker_claims_a_job(self):
+        school = School.objects.create(name="S", address="a", email="s@example.com", phone="1")
+        job = GenerationJob.objects.create(school=school, params={"school": school.pk})
+        workers = 8
+        barrier = threading.Barrier(workers)
+        claims, errors = [], []
+
+        def claim(i):
+            try:
+                barrier.wait()
+                claims.append(claim_next_job(f"w{i}"))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=claim, args=(i,)) for i in range(workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        won = [c for c in claims if c is not None]
+        self.assertEqual([c.pk for c in won], [job.pk])
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.worker), ("RUNNING", won[0].worker))
+
+
+class PublicLinkCacheTests(TestCase):
+    def setUp(self):
+        school = School.objects.create(name="S", address="a", email="s@example.com", phone="1")
+        classroom = ClassRoom.objects.create(school=school, class_name="5", total_students=1)
+        form = FormTemplate.objects.create(school=school, name="F", fields=[
+            {"name": "full_name", "type": "text", "required": True, "map_to": "full_name"},
+        ])
+        self.link = UploadLink.objects.create(school=school, classroom=classroom, template=form)
+        self.client = APIClient()
+
+    def test_rotated_token_stops_resolving(self):
+        old = self.link.token
+        self.assertEqual(self.client.get(f"/api/public/form/{old}/").status_code, 200)  # cached now
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            link = UploadLink.objects.get(pk=self.link.pk)  # as rotate_token loads it
+            link.token = uuid.uuid4()
+            link.save()
+            self.assertEqual(self.client.get(f"/api/public/form/{old}/").status_code, 200)  # not committed yet
+        self.assertTrue(callbacks)
+
+        self.assertEqual(self.client.get(f"/api/public/form/{old}/").status_code, 404)
+        self.assertEqual(self.client.get(f"/api/public/form/{link.token}/").status_code, 200)
+
+
+def _alias_for(engine):
+    return next((alias for alias, cfg in settings.DATABASES.items() if cfg["ENGINE"].endswith(engine)), None)
+
+
+SQLITE_ALIAS = _alias_for("sqlite3")
+POSTGRES_ALIAS = _alias_for("postgresql")
+
+
+class _UseAlias:
+    """Router sending every query to one database, so the views under test hit it."""
+    def __init__(self, alias):
+        self.alias = alias
+
+    def db_for_read(self, model, **hints):
+        return self.alias
+
+    def db_for_write(self, model, **hints):
+        return self.alias
+
+
+class UploadLinkStressMixin:
+    """
+    Parents of a whole class submitting at once: N concurrent POSTs against a link with
+    max_uses < N must create exactly max_uses students and leave uses_count == max_uses.
+    """
+    alias = None
+    submissions = 60
+    max_uses = 40
+
+    def test_concurrent_submissions_respect_max_uses(self):
+        with override_settings(DATABASE_ROUTERS=[_UseAlias(self.alias)]):
+            school = School.objects.create(name="S", address="a", email="s@example.com", phone="1")
+            classroom = ClassRoom.objects.create(school=school, class_name="5", total_students=self.submissions)
+            form = FormTemplate.objects.create(school=school, name="F", fields=[
+                {"name": "full_name", "type": "text", "required": True, "map_to": "full_name"},
+            ])
+            link = UploadLink.objects.create(school=school, classroom=classroom, template=form,
+                                             max_uses=self.max_uses)
+
+            barrier = threading.Barrier(self.submissions)
+            statuses, errors = [], []
+
+            def submit(i):
+                try:
+                    client = APIClient()
+                    barrier.wait()
+                    response = client.post(f"/api/public/upload/{link.token}/", {"full_name": f"Kid {i}"},
+                                           format="multipart")
+                    statuses.append(response.status_code)
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    connections.close_all()
+
+            threads = [threading.Thread(target=submit, args=(i,)) for i in range(self.submissions)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            self.assertEqual(errors, [])
+            self.assertEqual(statuses.count(201), self.max_uses)
+            self.assertEqual(statuses.count(400), self.submissions - self.max_uses)
+            link.refresh_from_db()
+            self.assertEqual(link.uses_count, self.max_uses)
+            self.assertEqual(Student.objects.filter(school=school).count(), self.max_uses)
+
+
+@unittest.skipUnless(SQLITE_ALIAS, "no SQLite database configured")
+class UploadLinkStressSQLiteTests(UploadLinkStressMixin, TransactionTestCase):
+    alias = SQLITE_ALIAS
+    databases = {SQLITE_ALIAS} if SQLITE_ALIAS else set()
+
+
+@unittest.skipUnless(POSTGRES_ALIAS, "no Postgres database configured")
+class UploadLinkStressPostgresTests(UploadLinkStressMixin, TransactionTestCase):
+    alias = POSTGRES_ALIAS
+    databases = {POSTGRES_ALIAS} if POSTGRES_ALIAS else set()
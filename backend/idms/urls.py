@@ -9,6 +9,7 @@ from .views_admin import (
     StudentViewSet,
     IdCardTemplateViewSet,
     DashboardViewSet,
+    GenerationJobViewSet,
     ChangePasswordView,   # ✅ added here
 )
 from .views import public_submit_student, public_link_info, public_form_schema, test_api
@@ -23,6 +24,7 @@ router.register(r"upload-links", UploadLinkViewSet, basename="upload-links")
 router.register(r"form-templates", FormTemplateViewSet)
 router.register(r"users", UserViewSet, basename="users")
 router.register(r"id-templates", IdCardTemplateViewSet, basename="id-templates")
+router.register(r"generation-jobs", GenerationJobViewSet, basename="generation-jobs")
 
 
 urlpatterns = [
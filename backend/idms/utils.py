@@ -1,10 +1,21 @@
 # backend/idcards/utils.py
-from PIL import Image, ImageDraw, ImageFont, ImageOps
-import io, os, math, json
+from PIL import Image, ImageChops, ImageColor, ImageDraw, ImageFont, ImageOps
+import io, os, math, json, threading, pickle, tempfile, hashlib, logging, time
+import multiprocessing
+from collections import OrderedDict, deque
+from contextlib import nullcontext
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4, A3
 from reportlab.lib.utils import ImageReader
 
+from .storage_cache import local_media_path, media_version
+
+# bump whenever a change alters rendered pixels: it is part of every rendered-card cache key
+RENDER_VERSION = 1
+
 MM_TO_PT = 72.0 / 25.4
 IN_TO_PT = 72.0
 
@@ -22,8 +33,15 @@ DEFAULT_FONT_DIRS = [
     "/usr/share/fonts/",
 ]
 
+logger = logging.getLogger(__name__)
+
+# process-wide bound on distinct (font, size) pairs kept parsed in memory
+FONT_CACHE_SIZE = 512
+MIN_FONT_SIZE = 6
+
 def mm_to_pt(mm): return mm * MM_TO_PT
 
+@lru_cache(maxsize=128)
 def find_font_path(font_name: str):
     if not font_name:
         return None
@@ -33,7 +51,13 @@ def find_font_path(font_name: str):
             return path
     return None
 
+@lru_cache(maxsize=FONT_CACHE_SIZE)
 def load_font(font_name: str, size: int):
+    """
+    Load a TTF by file name at the given size. Results are memoized (LRU keyed by
+    (font_name, size)) so repeated renders never re-scan font dirs or re-parse the file.
+    Returned fonts are shared: treat them as read-only.
+    """
     path = find_font_path(font_name)
     try:
         if path:
@@ -42,6 +66,224 @@ def load_font(font_name: str, size: int):
         pass
     return ImageFont.load_default()
 
+# ---------- instrumentation ----------
+class _Phase:
+    __slots__ = ("timings", "name", "start")
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.timings.add(self.name, time.perf_counter() - self.start)
+
+class RenderTimings:
+    """
+    Opt-in wall-clock samples per render phase (background, photo_open, text_fit,
+    encode, embed, ...). Pass one to generate_id_cards / render_card_image /
+    paste_photo_exact and read summary() afterwards; pass nothing and the
+    NULL_TIMINGS no-op is used instead.
+    """
+    enabled = True
+
+    def __init__(self):
+        self.samples = {}
+        self.counters = {}
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def add(self, name, seconds):
+        self.samples.setdefault(name, []).append(seconds)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def export(self):
+        return {"samples": self.samples, "counters": self.counters}
+
+    def merge(self, exported):
+        """Fold in another collector's export() (e.g. from a render worker process)."""
+        for name, values in exported["samples"].items():
+            self.samples.setdefault(name, []).extend(values)
+        for name, n in exported["counters"].items():
+            self.count(name, n)
+
+    @staticmethod
+    def _pct(sorted_values, q):
+        idx = min(len(sorted_values) - 1, max(0, int(math.ceil(q * len(sorted_values))) - 1))
+        return sorted_values[idx]
+
+    def summary(self):
+        phases = {}
+        for name, values in self.samples.items():
+            ordered = sorted(values)
+            phases[name] = {
+                "count": len(ordered),
+                "total_ms": round(sum(ordered) * 1000, 2),
+                "mean_ms": round(sum(ordered) * 1000 / len(ordered), 3),
+                "p50_ms": round(self._pct(ordered, 0.50) * 1000, 3),
+                "p90_ms": round(self._pct(ordered, 0.90) * 1000, 3),
+                "p99_ms": round(self._pct(ordered, 0.99) * 1000, 3),
+                "max_ms": round(ordered[-1] * 1000, 3),
+            }
+        return {"phases": phases, "counters": dict(self.counters)}
+
+class _NullTimings:
+    enabled = False
+    _null = nullcontext()
+
+    def phase(self, name):
+        return self._null
+
+    def add(self, name, seconds):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def merge(self, exported):
+        pass
+
+NULL_TIMINGS = _NullTimings()
+
+class BackgroundCache:
+    """
+    Decoded RGBA template backgrounds, shared by every render in the process.
+    Keyed by (template id, file name, mtime or etag, size) so a re-uploaded background is
+    never served stale, plus the pixel size it was resampled to (None = native); bounded by
+    total decoded bytes (LRU). Callers get a copy they may draw on.
+    """
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(template):
+        bg = template.background
+        return (template.pk, bg.name) + tuple(media_version(bg))
+
+    @staticmethod
+    def native_size(template):
+        """Pixel size of the uploaded background (reads the header only)."""
+        with Image.open(local_media_path(template.background)) as im:
+            return im.size
+
+    def get(self, template, size=None):
+        key = self.key(template) + (tuple(size) if size else None,)
+        with self._lock:
+            img = self._entries.get(key)
+            if img is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return img.copy()
+            self.misses += 1
+
+        img = Image.open(local_media_path(template.background)).convert("RGBA")
+        if size and tuple(size) != img.size:
+            img = img.resize(tuple(size), Image.LANCZOS)
+        nbytes = img.width * img.height * 4
+        with self._lock:
+            # drop stale versions of this template's file before inserting the new one
+            for k in [k for k in self._entries if k[0] == key[0] and k[:4] != key[:4]]:
+                self._discard(k)
+            if key not in self._entries and nbytes <= self.max_bytes:
+                self._entries[key] = img
+                self._bytes += nbytes
+                while self._bytes > self.max_bytes:
+                    self._discard(next(iter(self._entries)))
+        return img.copy()
+
+    def _discard(self, key):
+        img = self._entries.pop(key)
+        self._bytes -= img.width * img.height * 4
+
+    def evict(self, template_id):
+        with self._lock:
+            for k in [k for k in self._entries if k[0] == template_id]:
+                self._discard(k)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "entries": len(self._entries), "bytes": self._bytes}
+
+background_cache = BackgroundCache()
+
+def measure_text(draw, text, font):
+    """Return (width, height) of `text` rendered with `font`."""
+    try:
+        bbox = draw.textbbox((0, 0), text, font=font)
+        return bbox[2] - bbox[0], bbox[3] - bbox[1]
+    except Exception:
+        return draw.textsize(text, font=font)
+
+def fit_font(draw, text, font_name, base_size, max_width, max_height, min_size=MIN_FONT_SIZE):
+    """
+    Find the largest font size <= base_size at which `text` fits in (max_width, max_height).
+    Uses bisection over the size range, so a fit costs O(log n) measurements instead of
+    one per point size. Falls back to `min_size` when nothing fits (same as the old
+    shrink loop). Returns (font, text_w, text_h).
+    """
+    font = load_font(font_name, base_size)
+    text_w, text_h = measure_text(draw, text, font)
+    if base_size <= min_size or (text_w <= max_width and text_h <= max_height):
+        return font, text_w, text_h
+
+    # invariant: `lo` is the best known size (fits, or the floor); everything > hi fails
+    lo, hi = min_size, base_size - 1
+    best = None
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        f = load_font(font_name, mid)
+        mw, mh = measure_text(draw, text, f)
+        if mw <= max_width and mh <= max_height:
+            lo = mid
+            best = (f, mw, mh)
+        else:
+            hi = mid - 1
+    if best is not None:
+        return best
+    font = load_font(font_name, lo)
+    text_w, text_h = measure_text(draw, text, font)
+    return font, text_w, text_h
+
+def layout_text_field(draw, f, text, card_w, card_h, timings=NULL_TIMINGS):
+    """
+    Shrink-to-fit and alignment for one TextField, shared by raster and vector text.
+    Returns (font, x, y): where PIL draws the text's top-left, in card pixels.
+    """
+    max_width = max(1, int(f.w or card_w))
+    max_height = max(1, int(f.h or card_h))
+
+    # Largest size <= base that fits the box (bisection over cached fonts)
+    with timings.phase("text_fit"):
+        font, text_w, text_h = fit_font(draw, text, f.font_name, f.base_size, max_width, max_height)
+
+    # Center vertically within box
+    start_y = f.y + max(0, (f.h - text_h) // 2)
+
+    # Align horizontally
+    if f.align == "center":
+        text_x = f.x + max(0, (f.w - text_w) // 2)
+    elif f.align == "right":
+        text_x = f.x + max(0, (f.w - text_w))
+    else:
+        text_x = f.x
+    return font, text_x, start_y
+
 def _antialiased_polygon_mask(size, polygon_points):
     """
     Create an anti-aliased mask for a polygon by drawing into a larger temporary image and downscaling.
@@ -55,47 +297,13 @@ def _antialiased_polygon_mask(size, polygon_points):
     ImageDraw.Draw(tmp).polygon(scaled, fill=255)
     return tmp.resize((w, h), resample=Image.LANCZOS)
 
-def paste_photo_exact(card: Image.Image, photo_path: str, x:int, y:int, w:int, h:int, shape: str | None = None):
-    """
-    Paste photo into `card` at (x,y) with target size (w,h).
-    If `shape` provided, apply a mask (circle, hexagon, rounded rect, etc).
-    Coordinates x,y,w,h are in card pixel coordinates.
-    """
-    try:
-        img = Image.open(photo_path).convert("RGBA")
-    except Exception:
-        return
-
-    if w <= 0 or h <= 0:
-        return
+# distinct (shape, w, h) photo masks kept per process
+MASK_CACHE_SIZE = 64
 
-    # Resize to cover (like CSS cover): fill the box, center-cropped
-    img_w, img_h = img.size
-    img_ratio = img_w / img_h
-    box_ratio = float(w) / float(h)
-    if img_ratio > box_ratio:
-        # image wider -> match height
-        new_h = h
-        new_w = int(round(h * img_ratio))
-    else:
-        # image taller or equal -> match width
-        new_w = w
-        new_h = int(round(w / img_ratio))
-
-    img = img.resize((new_w, new_h), Image.LANCZOS)
-    left = max(0, (new_w - w)//2)
-    top = max(0, (new_h - h)//2)
-    cropped = img.crop((left, top, left + w, top + h))
-
-    # dest layer
-    layer = Image.new("RGBA", (w, h), (0,0,0,0))
-    layer.paste(cropped, (0,0), cropped)
-
-    # create mask
+@lru_cache(maxsize=MASK_CACHE_SIZE)
+def _build_photo_mask(s, w, h):
     mask = Image.new("L", (w, h), 0)
     draw = ImageDraw.Draw(mask)
-    s = (shape or "square")
-    s = str(s).lower()
 
     if s in ("square", "rectangle"):
         draw.rectangle([0,0,w,h], fill=255)
@@ -125,191 +333,437 @@ def paste_photo_exact(card: Image.Image, photo_path: str, x:int, y:int, w:int, h
     else:
         # default full rect
         draw.rectangle([0,0,w,h], fill=255)
+    return mask
+
+def photo_mask(shape, w, h):
+    """
+    L-mode mask that clips a (w,h) photo to `shape`. Masks depend only on
+    (shape, w, h), so they are memoized and shared: do not draw on the result.
+    """
+    return _build_photo_mask(str(shape or "square").lower(), w, h)
 
-    # Paste with mask (use alpha composite if paste with mask fails)
+DRAFT_PHOTO_CACHE_SIZE = 32
+
+@lru_cache(maxsize=DRAFT_PHOTO_CACHE_SIZE)
+def _open_draft_photo(photo_path, identity, w, h):
+    # JPEG decoders can downscale by 1/2..1/8 while decoding; stop at the cover size.
+    # Memoized on the file identity: the editor re-renders the same photo on every change.
+    img = Image.open(photo_path)
+    cover = max(w / img.width, h / img.height)
+    img.draft("RGB", (math.ceil(img.width * cover), math.ceil(img.height * cover)))
+    return img.convert("RGBA")
+
+def paste_photo_exact(card: Image.Image, photo_path: str, x:int, y:int, w:int, h:int, shape: str | None = None, mask=None,
+                      timings=NULL_TIMINGS, draft=False, composite=False, image=None):
+    """
+    Paste photo into `card` at (x,y) with target size (w,h).
+    If `shape` provided, apply a mask (circle, hexagon, rounded rect, etc).
+    A prebuilt `mask` (see photo_mask) takes precedence over `shape`.
+    Coordinates x,y,w,h are in card pixel coordinates.
+    With `draft`, JPEG photos are decoded at a reduced scale (no smaller than the box).
+    `composite` alpha-composites instead of pasting, for transparent cards (layers).
+    `image` is the already decoded RGBA photo (see decode_photos); `photo_path` is then unused.
+    """
     try:
-        card.paste(layer, (x, y), mask)
+        with timings.phase("photo_open"):
+            if image is not None:
+                img = image
+            elif draft and w > 0 and h > 0:
+                img = _open_draft_photo(photo_path, tuple(_file_identity(photo_path) or ()), w, h)
+            else:
+                img = Image.open(photo_path).convert("RGBA")
     except Exception:
-        tmp = Image.new("RGBA", card.size)
-        tmp.paste(layer, (x, y))
-        card.alpha_composite(tmp)
-
-# ---------- render_card_image with helpers ----------
-def render_card_image(student, template):
-    """Render card image at template background's native pixel size using template.fields (image-pixel coords)."""
-    bg_path = template.background.path
-    background = Image.open(bg_path).convert("RGBA")
-    draw = ImageDraw.Draw(background)
-    fields = template.fields or {}
+        return
 
-    # helper functions
-    def _normalize_key_variants(key: str):
-        variants = [key, key.lower(), key.replace(" ", "_"), key.replace(" ", "_").lower()]
-        seen = set()
-        out = []
-        for v in variants:
-            if v not in seen:
-                seen.add(v)
-                out.append(v)
-        return out
-
-    def _get_meta_dict(s):
-        meta = None
-        if isinstance(s, dict):
-            meta = s.get("meta") or s.get("metadata") or s.get("Meta")
-        else:
-            meta = getattr(s, "meta", None)
-        if isinstance(meta, str):
-            try:
-                parsed = json.loads(meta)
-                if isinstance(parsed, dict):
-                    return parsed
-            except Exception:
-                return {}
-        if isinstance(meta, dict):
-            return meta
-        return {}
-
-    def _get_from_obj_or_dict(s, key):
-        if not isinstance(s, dict):
-            if hasattr(s, key):
-                return getattr(s, key)
-            lower = key.lower()
-            if hasattr(s, lower):
-                return getattr(s, lower)
-            snake = key.replace(" ", "_").lower()
-            if hasattr(s, snake):
-                return getattr(s, snake)
+    if w <= 0 or h <= 0:
+        return
+
+    # Resize to cover (like CSS cover): fill the box, center-cropped
+    img_w, img_h = img.size
+    img_ratio = img_w / img_h
+    box_ratio = float(w) / float(h)
+    if img_ratio > box_ratio:
+        # image wider -> match height
+        new_h = h
+        new_w = int(round(h * img_ratio))
+    else:
+        # image taller or equal -> match width
+        new_w = w
+        new_h = int(round(w / img_ratio))
+
+    with timings.phase("photo_resize"):
+        img = img.resize((new_w, new_h), Image.LANCZOS)
+        left = max(0, (new_w - w)//2)
+        top = max(0, (new_h - h)//2)
+        cropped = img.crop((left, top, left + w, top + h))
+
+    with timings.phase("photo_paste"):
+        # dest layer
+        layer = Image.new("RGBA", (w, h), (0,0,0,0))
+        layer.paste(cropped, (0,0), cropped)
+
+        if mask is None:
+            mask = photo_mask(shape, w, h)
+
+        if composite:
+            # pasting through the mask would premultiply the edge pixels of a transparent card
+            alpha = ImageChops.multiply(cropped.getchannel("A"), mask) if mask is not None else cropped.getchannel("A")
+            photo = cropped.copy()
+            photo.putalpha(alpha)
+            card.alpha_composite(photo, (x, y))
+            return
+
+        # Paste with mask (use alpha composite if paste with mask fails)
+        try:
+            card.paste(layer, (x, y), mask)
+        except Exception:
+            tmp = Image.new("RGBA", card.size)
+            tmp.paste(layer, (x, y))
+            card.alpha_composite(tmp)
+
+# ---------- student value lookup ----------
+def _normalize_key_variants(key: str):
+    variants = [key, key.lower(), key.replace(" ", "_"), key.replace(" ", "_").lower()]
+    seen = set()
+    out = []
+    for v in variants:
+        if v not in seen:
+            seen.add(v)
+            out.append(v)
+    return out
+
+def _get_meta_dict(s):
+    meta = None
+    if isinstance(s, dict):
+        meta = s.get("meta") or s.get("metadata") or s.get("Meta")
+    else:
+        meta = getattr(s, "meta", None)
+    if isinstance(meta, str):
+        try:
+            parsed = json.loads(meta)
+            if isinstance(parsed, dict):
+                return parsed
+        except Exception:
+            return {}
+    if isinstance(meta, dict):
+        return meta
+    return {}
+
+class _KeyLookup:
+    """One key resolved against an object (attribute variants) or a dict (key variants)."""
+    __slots__ = ("attrs", "keys")
+
+    def __init__(self, key):
+        self.attrs = tuple(dict.fromkeys([key, key.lower(), key.replace(" ", "_").lower()]))
+        self.keys = tuple(_normalize_key_variants(key))
+
+    def __call__(self, s):
         if isinstance(s, dict):
-            for k in _normalize_key_variants(key):
+            for k in self.keys:
                 if k in s:
                     return s[k]
+            return None
+        for a in self.attrs:
+            if hasattr(s, a):
+                return getattr(s, a)
         return None
 
-    def get_student_value(s, field_name):
-        # nested lookup support
-        if "." in field_name:
-            parts = field_name.split(".")
+class FieldAccessor:
+    """
+    Precompiled form of the student value lookup: dotted path, then direct
+    attribute/key, then `meta` (name variants, then a sanitized fallback key).
+    Call with (student, meta) where meta is the student's parsed meta dict.
+    """
+    __slots__ = ("name", "parts", "direct", "meta_keys")
+
+    def __init__(self, field_name):
+        self.name = field_name
+        self.parts = tuple(_KeyLookup(p) for p in field_name.split(".")) if "." in field_name else ()
+        self.direct = _KeyLookup(field_name)
+        fallback_key = "".join(ch if ch.isalnum() or ch == "_" else "_" for ch in field_name).lower()
+        self.meta_keys = tuple(dict.fromkeys(_normalize_key_variants(field_name) + [fallback_key]))
+
+    def __call__(self, s, meta):
+        if self.parts:
             cur = s
-            for p in parts:
-                cur = _get_from_obj_or_dict(cur, p)
+            for lookup in self.parts:
+                cur = lookup(cur)
                 if cur is None:
                     break
             if cur is not None:
                 return cur
 
-        val = _get_from_obj_or_dict(s, field_name)
+        val = self.direct(s)
         if val is not None:
             return val
 
-        meta = _get_meta_dict(s)
         if meta:
-            for k in _normalize_key_variants(field_name):
+            for k in self.meta_keys:
                 if k in meta:
                     return meta[k]
-
-        fallback_key = "".join(ch if ch.isalnum() or ch == "_" else "_" for ch in field_name).lower()
-        if meta and fallback_key in meta:
-            return meta[fallback_key]
         return None
 
-    # debug: print template fields to server logs to verify 'shape' and 'align'
+def _resolve_photo_path(photo_attr):
     try:
-        print("TEMPLATE FIELDS:", json.dumps(fields, indent=2))
+        if photo_attr is None:
+            return None
+        if hasattr(photo_attr, "storage"):
+            # FieldFile: read through the storage API (remote files via the local disk cache)
+            return local_media_path(photo_attr) if photo_attr else None
+        if hasattr(photo_attr, "path"):
+            return photo_attr.path
+        if isinstance(photo_attr, dict):
+            return photo_attr.get("path") or photo_attr.get("url") or photo_attr.get("file")
+        if isinstance(photo_attr, str):
+            return photo_attr
+        if hasattr(photo_attr, "url"):
+            return getattr(photo_attr, "url")
     except Exception:
-        print("TEMPLATE FIELDS (raw):", fields)
+        return None
+    return None
+
+# ---------- compiled render plan ----------
+_PHOTO_ACCESSORS = (FieldAccessor("photo"), FieldAccessor("photo_path"), FieldAccessor("photo_url"))
+# normalized print derivative (see idms.photos); used instead of the raw upload once it exists
+_PRINT_PHOTO_ACCESSOR = FieldAccessor("photo_print")
+
+@dataclass(frozen=True)
+class PhotoField:
+    name: str
+    x: int
+    y: int
+    w: int
+    h: int
+    shape: str | None
+    mask: Image.Image | None
+
+@dataclass(frozen=True)
+class TextField:
+    name: str
+    accessor: FieldAccessor
+    x: int
+    y: int
+    w: int
+    h: int
+    font_name: str
+    base_size: int
+    color: str
+    align: str
+
+@dataclass(frozen=True)
+class RenderPlan:
+    """
+    An IdCardTemplate compiled for rendering: every field's accessor, box, font
+    and mask resolved once, so applying it to a student does no interpretation.
+    Build with compile_template(); render with render_card_image(student, template, plan).
+    """
+    template_id: int | None
+    fields: tuple
+    digest: str = ""  # content hash of the fields the plan was compiled from
+    size: tuple | None = None  # card pixel size; None = background's native size
+    draft: bool = False  # fast, lower-fidelity photo decoding (editor previews)
+    vector_text: bool = False  # text fields are left out of the raster (see draw_vector_text)
+
+    def photo_source(self, student, meta):
+        """The student's photo attribute (FieldFile, path or dict) the card is rendered from."""
+        printable = _PRINT_PHOTO_ACCESSOR(student, meta)
+        if printable:
+            return printable
+        photo_attr = _PHOTO_ACCESSORS[0](student, meta)
+        if photo_attr is None:
+            photo_attr = _PHOTO_ACCESSORS[1](student, meta) or _PHOTO_ACCESSORS[2](student, meta)
+        return photo_attr
+
+    def photo_path(self, student, meta):
+        return _resolve_photo_path(self.photo_source(student, meta))
+
+    def fingerprint(self, student):
+        """Stable digest of everything this plan reads from `student` (photo by file identity)."""
+        meta = _get_meta_dict(student)
+        parts = []
+        for f in self.fields:
+            if isinstance(f, PhotoField):
+                parts.append([f.name] + _photo_identity(self.photo_source(student, meta)))
+            else:
+                value = f.accessor(student, meta)
+                parts.append([f.name, None if value is None else str(value).strip()])
+        return hashlib.sha1(json.dumps(parts, default=str).encode()).hexdigest()
+
+def _photo_identity(photo_attr):
+    # [name, version] without fetching the file, so a cache hit costs no download
+    if hasattr(photo_attr, "storage"):
+        if not photo_attr:
+            return [None, None]
+        try:
+            return [photo_attr.name, media_version(photo_attr)]
+        except Exception:
+            return [photo_attr.name, None]
+    path = _resolve_photo_path(photo_attr)
+    return [path, _file_identity(path)]
+
+def _file_identity(path):
+    if not path:
+        return None
+    try:
+        st = os.stat(path)
+    except (OSError, TypeError, ValueError):
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+def _is_photo_field(field_name, cfg):
+    return bool((cfg or {}).get("isImage")) or field_name.lower() == "photo"
+
+def student_attribute_names(template):
+    """
+    Every attribute name rendering `template` may read from a student object (e.g. for
+    QuerySet.only()). Read off template.fields: no plan is compiled, no background opened.
+    """
+    fields = template.fields or {}
+    accessors = ([FieldAccessor(name) for name, cfg in fields.items() if not _is_photo_field(name, cfg)]
+                 + list(_PHOTO_ACCESSORS) + [_PRINT_PHOTO_ACCESSOR])
+    names = {"meta"}
+    for acc in accessors:
+        names.update(acc.direct.attrs)
+        if acc.parts:
+            names.update(acc.parts[0].attrs)
+    return names
+
+def _compile_field(field_name, cfg, sx=1.0, sy=1.0):
+    # field coords are in background pixels; (sx, sy) maps them onto the render size
+    cfg = cfg or {}
+    x = int(round(cfg.get("x", 0) * sx))
+    y = int(round(cfg.get("y", 0) * sy))
+    w = int(round(cfg.get("width", cfg.get("w", 0)) * sx))
+    h = int(round(cfg.get("height", cfg.get("h", 0)) * sy))
+
+    if _is_photo_field(field_name, cfg):
+        shape = cfg.get("shape")
+        mask = photo_mask(shape, w, h) if w > 0 and h > 0 else None
+        return PhotoField(field_name, x, y, w, h, shape, mask)
+
+    font_name = cfg.get("font", "arial.ttf")
+    if "size" in cfg:
+        base_size = max(1, int(round(cfg["size"] * min(sx, sy))))
+    else:
+        base_size = int(round(max(10, (h // 2 if h else 14))))
+    load_font(font_name, base_size)  # warm the font cache
+    return TextField(
+        field_name, FieldAccessor(field_name), x, y, w, h, font_name, base_size,
+        cfg.get("color", "#000000"), (cfg.get("align") or "left").lower(),
+    )
+
+PLAN_CACHE_SIZE = 32
+_plan_cache = OrderedDict()
+_plan_lock = threading.Lock()
+
+def card_pixel_size(template, dpi):
+    """Pixel size of the template's card (card_size_mm) printed at `dpi`."""
+    cs = getattr(template, "card_size_mm", None) or {"w":54,"h":86}
+    return (max(1, int(round(cs.get("w", 54) / 25.4 * dpi))),
+            max(1, int(round(cs.get("h", 86) / 25.4 * dpi))))
+
+def compile_template(template, dpi=None, size=None, draft=False, vector_text=False):
+    """
+    Return the RenderPlan for `template`, memoized per (template id, fields content, size, flags,
+    and for a resized card the background version, whose native size sets the scaling).
+    With a `dpi` (default: template.render_dpi) the card renders at card_size_mm x dpi
+    pixels instead of the background's native size, and boxes/fonts are scaled to match.
+    An explicit pixel `size` takes precedence over dpi.
+    Edited-but-unsaved field dicts get their own plan; saves evict via evict_plan().
+    """
+    fields = template.fields or {}
+    fields_json = json.dumps(fields, sort_keys=True, default=str)
+    if size is None:
+        dpi = dpi or getattr(template, "render_dpi", None)
+        size = card_pixel_size(template, dpi) if dpi else None
+    size = tuple(size) if size else None
+    # a re-uploaded background may have another native size: other processes can't
+    # rely on evict_plan() from the saving one
+    background = background_cache.key(template) if size else None
+    key = (template.pk, fields_json, size, draft, vector_text, background)
+    with _plan_lock:
+        plan = _plan_cache.get(key)
+        if plan is not None:
+            _plan_cache.move_to_end(key)
+            return plan
+
+    # enable DEBUG on the "idms.utils" logger to verify 'shape' and 'align'
+    logger.debug("compiling template %s fields: %s", template.pk, fields_json)
+
+    sx = sy = 1.0
+    if size:
+        native_w, native_h = background_cache.native_size(template)
+        sx, sy = size[0] / native_w, size[1] / native_h
 
     # iterate in deterministic order
-    for field_name in list(fields.keys()):
-        cfg = fields[field_name] or {}
-        x = int(round(cfg.get("x", 0)))
-        y = int(round(cfg.get("y", 0)))
-        w = int(round(cfg.get("width", cfg.get("w", 0))))
-        h = int(round(cfg.get("height", cfg.get("h", 0))))
+    plan = RenderPlan(
+        template_id=template.pk,
+        fields=tuple(_compile_field(name, fields[name], sx, sy) for name in list(fields.keys())),
+        digest=hashlib.sha1(fields_json.encode()).hexdigest(),
+        size=size,
+        draft=draft,
+        vector_text=vector_text,
+    )
+    with _plan_lock:
+        _plan_cache[key] = plan
+        while len(_plan_cache) > PLAN_CACHE_SIZE:
+            _plan_cache.popitem(last=False)
+    return plan
+
+def evict_plan(template_id):
+    with _plan_lock:
+        for k in [k for k in _plan_cache if k[0] == template_id]:
+            del _plan_cache[k]
+
+def render_card_image(student, template, plan=None, timings=NULL_TIMINGS, layer_only=False, photos=None):
+    """
+    Render card image at plan.size (default: the background's native pixel size) using template.fields.
+    With `layer_only` only the student's photo and text are drawn, on a transparent
+    RGBA card (the "layered" PDF format puts the background underneath separately).
+    `photos` maps photo field names to images already decoded by decode_photos().
+    """
+    if plan is None:
+        plan = compile_template(template)
+    if layer_only:
+        background = Image.new("RGBA", plan.size or background_cache.native_size(template), (0, 0, 0, 0))
+        # "RGBA" draw mode composites text over the transparent pixels instead of replacing them
+        draw = ImageDraw.Draw(background, "RGBA")
+    else:
+        with timings.phase("background"):
+            background = background_cache.get(template, plan.size)
+        draw = ImageDraw.Draw(background)
+    meta = _get_meta_dict(student)
 
+    for f in plan.fields:
         # image/photo
-        if cfg.get("isImage") or field_name.lower() == "photo":
-            photo_attr = get_student_value(student, "photo")
-            photo_path = None
-            if photo_attr is None:
-                photo_attr = get_student_value(student, "photo_path") or get_student_value(student, "photo_url")
-
-            try:
-                if photo_attr is None:
-                    pass
-                elif hasattr(photo_attr, "path"):
-                    photo_path = photo_attr.path
-                elif isinstance(photo_attr, dict):
-                    photo_path = photo_attr.get("path") or photo_attr.get("url") or photo_attr.get("file")
-                elif isinstance(photo_attr, str):
-                    photo_path = photo_attr
-                elif hasattr(photo_attr, "url"):
-                    photo_path = getattr(photo_attr, "url")
-            except Exception:
-                photo_path = None
-
-            if photo_path:
+        if isinstance(f, PhotoField):
+            image = photos.get(f.name) if photos else None
+            photo_path = None if image is not None else plan.photo_path(student, meta)
+            if image is not None or photo_path:
                 try:
-                    shape = cfg.get("shape")
-                    paste_photo_exact(background, photo_path, x, y, w, h, shape=shape)
+                    paste_photo_exact(background, photo_path, f.x, f.y, f.w, f.h, shape=f.shape, mask=f.mask,
+                                      timings=timings, draft=plan.draft, composite=layer_only, image=image)
                 except Exception:
                     pass
             continue
 
-                # ---------- TEXT FIELDS (auto font shrink to fit box, no wrap) ----------
-        value = get_student_value(student, field_name)
+        # ---------- TEXT FIELDS (auto font shrink to fit box, no wrap) ----------
+        if plan.vector_text:
+            continue  # drawn on the PDF canvas by draw_vector_text()
+        value = f.accessor(student, meta)
         if value is None:
             continue
 
         text = str(value).strip()
-        font_name = cfg.get("font", "arial.ttf")
-        base_font_size = int(round(cfg.get("size", max(10, (h // 2 if h else 14)))))
-        color = cfg.get("color", "#000000")
-        align = (cfg.get("align") or "left").lower()
-
-        max_width = max(1, int(w or background.width))
-        max_height = max(1, int(h or background.height))
-
-        # Start from base size, shrink proportionally until it fits
-        font_size = base_font_size
-        font = load_font(font_name, font_size)
-
-        # Measure text width and height and adjust font size
-        while font_size > 6:
-            try:
-                bbox = draw.textbbox((0, 0), text, font=font)
-                text_w = bbox[2] - bbox[0]
-                text_h = bbox[3] - bbox[1]
-            except Exception:
-                text_w, text_h = draw.textsize(text, font=font)
-
-            if text_w <= max_width and text_h <= max_height:
-                break
-            font_size -= 1
-            font = load_font(font_name, font_size)
-
-        # Final bounding box check
-        try:
-            bbox = draw.textbbox((0, 0), text, font=font)
-            text_w = bbox[2] - bbox[0]
-            text_h = bbox[3] - bbox[1]
-        except Exception:
-            text_w, text_h = draw.textsize(text, font=font)
-
-        # Center vertically within box
-        start_y = y + max(0, (h - text_h) // 2)
-
-        # Align horizontally
-        if align == "center":
-            text_x = x + max(0, (w - text_w) // 2)
-        elif align == "right":
-            text_x = x + max(0, (w - text_w))
-        else:
-            text_x = x
+        font, text_x, start_y = layout_text_field(draw, f, text, background.width, background.height, timings)
 
         # Draw single-line, auto-shrunk text
-        draw.text((text_x, start_y), text, fill=color, font=font)
-    return background.convert("RGB")
+        with timings.phase("text_draw"):
+            draw.text((text_x, start_y), text, fill=f.color, font=font)
+    if layer_only:
+        return background
+    with timings.phase("card_convert"):
+        return background.convert("RGB")
 
 # ---------- grid + PDF functions (unchanged logic) ----------
 def compute_grid(paper_w_pt, paper_h_pt, card_w_pt, card_h_pt, margin_pt=18, spacing_pt=8):
@@ -328,19 +782,333 @@ def compute_grid(paper_w_pt, paper_h_pt, card_w_pt, card_h_pt, margin_pt=18, spa
     y_top = paper_h_pt - margin_pt - top_offset
     return cols, rows, cols*rows, x_start, y_top, used_w, used_h
 
-def generate_id_cards(students, template, paper="A4", margin_mm=10, spacing_mm=3, max_pages=None):
+def paper_size_pt(paper):
+    """(w, h) in points for a PAPER_SIZES name (unknown names fall back to A4) or a (w, h) pair."""
     if isinstance(paper, str):
-        paper = paper.upper()
-        if paper not in PAPER_SIZES:
-            paper_w_pt, paper_h_pt = PAPER_SIZES["A4"]
-        else:
-            paper_w_pt, paper_h_pt = PAPER_SIZES[paper]
-    else:
-        paper_w_pt, paper_h_pt = paper
+        return PAPER_SIZES.get(paper.upper(), PAPER_SIZES["A4"])
+    return paper
 
+def card_size_pt(template):
     cs = getattr(template, "card_size_mm", None) or {"w":54,"h":86}
-    card_w_pt = mm_to_pt(cs.get("w", 54))
-    card_h_pt = mm_to_pt(cs.get("h", 86))
+    return mm_to_pt(cs.get("w", 54)), mm_to_pt(cs.get("h", 86))
+
+def cards_per_page(template, paper="A4", margin_mm=10, spacing_mm=3):
+    """How many cards generate_id_cards fits on one sheet with these settings."""
+    return compute_grid(*paper_size_pt(paper), *card_size_pt(template), mm_to_pt(margin_mm), mm_to_pt(spacing_mm))[2]
+
+# generated PDFs stay in memory up to this size, then spill to a temp file on disk
+PDF_SPOOL_MAX_BYTES = 16 * 1024 * 1024
+
+# how cards are embedded in the PDF: "lossless" (raw pixels, Flate), "jpeg" (DCT), or
+# "layered" (background once as a shared form XObject + a transparent per-student layer)
+CARD_IMAGE_FORMATS = ("lossless", "jpeg", "layered")
+DEFAULT_JPEG_QUALITY = 90
+
+def encode_card(card_img, image_format="lossless", jpeg_quality=DEFAULT_JPEG_QUALITY):
+    """
+    Prepare a rendered card for the canvas without a PNG round-trip.
+    "lossless" returns the PIL image as-is (reportlab Flate-compresses its raw pixels);
+    "jpeg" returns JPEG bytes, which reportlab embeds verbatim as a DCT stream.
+    "layered" cards are transparent RGBA layers (render_card_image(layer_only=True)),
+    also returned as-is.
+    """
+    if image_format == "jpeg":
+        out = io.BytesIO()
+        card_img.save(out, format="JPEG", quality=int(jpeg_quality))
+        return out.getvalue()
+    return card_img
+
+def card_image_reader(encoded):
+    """Wrap the output of encode_card() for canvas.drawImage."""
+    if isinstance(encoded, bytes):
+        return ImageReader(io.BytesIO(encoded))
+    return ImageReader(encoded)
+
+# ---------- parallel rendering ----------
+_worker_template = None
+_worker_plan = None
+_worker_card_cache = None
+
+def _render_worker_init(template_bytes, card_cache=None, dpi=None, draft=False, vector_text=False):
+    global _worker_template, _worker_plan, _worker_card_cache
+    import django
+    from django.apps import apps
+    if not apps.ready:
+        # fresh interpreter: bring Django up before unpickling model instances
+        django.setup()
+    _worker_template = pickle.loads(template_bytes)
+    _worker_plan = compile_template(_worker_template, dpi, draft=draft, vector_text=vector_text)
+    _worker_card_cache = card_cache
+
+def _render_worker(student, image_format=None, jpeg_quality=DEFAULT_JPEG_QUALITY, cache_key=None, timed=False):
+    timings = RenderTimings() if timed else NULL_TIMINGS
+    with timings.phase("render"):
+        img = render_card_image(student, _worker_template, _worker_plan, timings=timings,
+                                layer_only=image_format == "layered")
+    out = img
+    if image_format:
+        with timings.phase("encode"):
+            out = encode_card(img, image_format, jpeg_quality)
+        if cache_key and _worker_card_cache is not None:
+            with timings.phase("cache_put"):
+                _worker_card_cache.put(cache_key, out, image_format)
+    # timings travel back with the card so the parent can aggregate them
+    return (out, timings.export()) if timed else out
+
+def _done(value):
+    f = Future()
+    f.set_result(value)
+    return f
+
+# ---------- photo read-ahead ----------
+PHOTO_PREFETCH_DEPTH = 4  # students whose photos are read ahead of the one rendering (0 = off)
+PHOTO_PREFETCH_THREADS = 4
+
+def decode_photos(student, plan):
+    """
+    Fetch and decode `student`'s photo for every photo field of `plan`, as paste_photo_exact
+    would, so render_card_image(..., photos=...) does no I/O. Photos that fail to load are left out.
+    """
+    meta = _get_meta_dict(student)
+    photo_path = None
+    photos = {}
+    for f in plan.fields:
+        if not isinstance(f, PhotoField) or f.w <= 0 or f.h <= 0:
+            continue
+        try:
+            photo_path = photo_path or plan.photo_path(student, meta)
+            if not photo_path:
+                break
+            if plan.draft:
+                photos[f.name] = _open_draft_photo(photo_path, tuple(_file_identity(photo_path) or ()), f.w, f.h)
+            else:
+                # one full decode serves every (differently sized) photo field
+                img = next((im for im in photos.values()), None)
+                photos[f.name] = img if img is not None else Image.open(photo_path).convert("RGBA")
+        except Exception:
+            continue
+    return photos
+
+def _prefetch_photos(entries, plan, depth=PHOTO_PREFETCH_DEPTH, threads=PHOTO_PREFETCH_THREADS, timings=NULL_TIMINGS):
+    """
+    Yield (student, key, hit, photos) for (student, key, hit) `entries`, in order. While
+    the caller renders one card, a thread pool decodes the photos of up to `depth` later
+    students (those without a cached card, `hit`), overlapping storage reads and JPEG
+    decoding with rendering. Counts photo_prefetch_hits (photos were ready when needed)
+    and photo_prefetch_waits; the time spent waiting is the photo_prefetch_wait phase.
+    """
+    if depth <= 0 or not any(isinstance(f, PhotoField) for f in plan.fields):
+        for student, key, hit in entries:
+            yield student, key, hit, None
+        return
+
+    def load(student):
+        start = time.perf_counter()
+        photos = decode_photos(student, plan)
+        timings.add("photo_prefetch", time.perf_counter() - start)
+        return photos
+
+    def take(student, key, hit, future):
+        if future is None:
+            return student, key, hit, None
+        if future.done():
+            timings.count("photo_prefetch_hits")
+        else:
+            timings.count("photo_prefetch_waits")
+        with timings.phase("photo_prefetch_wait"):
+            return student, key, hit, future.result()
+
+    timings.count("photo_prefetch_depth", depth)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max(1, min(threads, depth)), thread_name_prefix="photo-prefetch") as pool:
+        try:
+            for student, key, hit in entries:
+                pending.append((student, key, hit, pool.submit(load, student) if hit is None else None))
+                if len(pending) > depth:
+                    yield take(*pending.popleft())
+            while pending:
+                yield take(*pending.popleft())
+        finally:
+            for *_entry, future in pending:
+                if future is not None:
+                    future.cancel()
+
+def iter_card_images(students, template, workers=1, max_inflight=None, image_format=None, jpeg_quality=DEFAULT_JPEG_QUALITY,
+                     card_cache=None, timings=NULL_TIMINGS, dpi=None, draft=False, vector_text=False,
+                     prefetch=PHOTO_PREFETCH_DEPTH):
+    """
+    Yield rendered card images for `students`, in input order.
+    With workers > 1 the renders run in a process pool; at most `max_inflight`
+    cards (default 2 per worker) are queued or waiting to be consumed at any time.
+    If `image_format` is given, each card is passed through encode_card() first
+    (inside the worker, when there is one). With a `card_cache` (RenderedCardCache,
+    requires image_format) cards whose inputs are unchanged are read back instead
+    of rendered, and fresh renders are stored. Worker-side phase timings are
+    merged into `timings`. `dpi` overrides template.render_dpi, `draft` selects fast
+    photo decoding and `vector_text` leaves text out of the raster (see compile_template).
+    Without workers, the photos of the next `prefetch` students are read and decoded on
+    a thread pool while the current card renders (see _prefetch_photos).
+    """
+    plan = compile_template(template, dpi, draft=draft, vector_text=vector_text)
+    run_key = None
+    if card_cache is not None:
+        if not image_format:
+            raise ValueError("card_cache requires an image_format")
+        run_key = card_cache.run_key(template, plan, image_format, jpeg_quality)
+
+    def cached(student):
+        if run_key is None:
+            return None, None
+        with timings.phase("cache_get"):
+            key = card_cache.card_key(run_key, plan.fingerprint(student))
+            hit = card_cache.get(key, image_format)
+        timings.count("card_cache_hits" if hit is not None else "card_cache_misses")
+        return key, hit
+
+    if not workers or workers <= 1:
+        entries = ((student, *cached(student)) for student in students)
+        for student, key, hit, photos in _prefetch_photos(entries, plan, prefetch, timings=timings):
+            if hit is not None:
+                yield hit
+                continue
+            with timings.phase("render"):
+                img = render_card_image(student, template, plan, timings=timings,
+                                        layer_only=image_format == "layered", photos=photos)
+            if not image_format:
+                yield img
+                continue
+            with timings.phase("encode"):
+                encoded = encode_card(img, image_format, jpeg_quality)
+            if key:
+                with timings.phase("cache_put"):
+                    card_cache.put(key, encoded, image_format)
+            yield encoded
+        return
+
+    timed = timings.enabled
+    max_inflight = max(1, max_inflight or workers * 2)
+    # never fork: the caller may be a threaded web process, and a forked child can inherit
+    # a lock (plan/background caches, logging) held by another thread and deadlock on it
+    methods = multiprocessing.get_all_start_methods()
+    ctx = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+    executor = ProcessPoolExecutor(
+        max_workers=workers, mp_context=ctx,
+        initializer=_render_worker_init, initargs=(pickle.dumps(template), card_cache, dpi, draft, vector_text),
+    )
+
+    def result(future, from_worker):
+        with timings.phase("worker_wait"):
+            value = future.result()
+        if timed and from_worker:
+            value, exported = value
+            timings.merge(exported)
+        return value
+
+    pending = deque()
+    try:
+        for student in students:
+            key, hit = cached(student)
+            if hit is not None:
+                pending.append((_done(hit), False))
+            else:
+                pending.append((executor.submit(_render_worker, student, image_format, jpeg_quality, key, timed), True))
+            if len(pending) >= max_inflight:
+                yield result(*pending.popleft())
+        while pending:
+            yield result(*pending.popleft())
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+LAYERED_BACKGROUND_FORM = "idcard_background"
+# measuring-only draw surface for laying out vector text
+_measure_draw = ImageDraw.Draw(Image.new("L", (1, 1)))
+
+@lru_cache(maxsize=64)
+def pdf_font_name(font_path):
+    """Register the TTF at `font_path` with reportlab once; Helvetica if it can't be embedded."""
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    name = "idms-" + hashlib.sha1(font_path.encode()).hexdigest()[:12]
+    try:
+        pdfmetrics.registerFont(TTFont(name, font_path))
+    except Exception:
+        logger.warning("cannot embed font %s in PDF, using Helvetica", font_path)
+        return "Helvetica"
+    return name
+
+def draw_vector_text(c, student, plan, card_px, x_pt, y_pt, card_w_pt, card_h_pt, timings=NULL_TIMINGS):
+    """
+    Draw the plan's text fields for `student` as PDF text over the card cell at
+    (x_pt, y_pt). Layout is computed in card pixels exactly as render_card_image does.
+    """
+    meta = _get_meta_dict(student)
+    sx, sy = card_w_pt / card_px[0], card_h_pt / card_px[1]
+    for f in plan.fields:
+        if not isinstance(f, TextField):
+            continue
+        value = f.accessor(student, meta)
+        text = "" if value is None else str(value).strip()
+        if not text:
+            continue
+        font, text_x, start_y = layout_text_field(_measure_draw, f, text, card_px[0], card_px[1], timings)
+        with timings.phase("text_draw"):
+            path = getattr(font, "path", None)
+            name = pdf_font_name(path) if isinstance(path, str) else "Helvetica"
+            ascent = font.getmetrics()[0] if hasattr(font, "getmetrics") else 0
+            c.setFont(name, getattr(font, "size", f.base_size) * sy)
+            c.setFillColorRGB(*(v / 255 for v in ImageColor.getrgb(f.color)[:3]))
+            # PIL anchors at the ascender line, PDF text at the baseline
+            c.drawString(x_pt + text_x * sx, y_pt + card_h_pt - (start_y + ascent) * sy, text)
+
+def _draw_layered_card(c, layer, x_pt, y_pt, card_w_pt, card_h_pt):
+    """Place the shared background form at (x_pt, y_pt), then the student layer cropped to its content."""
+    c.saveState()
+    c.translate(x_pt, y_pt)
+    c.doForm(LAYERED_BACKGROUND_FORM)
+    c.restoreState()
+    bbox = layer.getbbox()  # alpha-only for RGBA: the photo and text area
+    if not bbox:
+        return
+    left, top, right, bottom = bbox
+    sx, sy = card_w_pt / layer.width, card_h_pt / layer.height
+    c.drawImage(ImageReader(layer.crop(bbox)), x_pt + left * sx, y_pt + (layer.height - bottom) * sy,
+                width=(right - left) * sx, height=(bottom - top) * sy, mask="auto")
+
+_NO_GROUP = object()
+
+def _draw_separator_page(c, label, paper_w_pt, paper_h_pt):
+    """A page with just the group label, so a printed stack can be split by class."""
+    c.setFillColorRGB(0, 0, 0)
+    c.setFont("Helvetica-Bold", 28)
+    c.drawCentredString(paper_w_pt / 2, paper_h_pt / 2, str(label if label is not None else "Unassigned"))
+    c.showPage()
+
+def generate_id_cards(students, template, paper="A4", margin_mm=10, spacing_mm=3, max_pages=None, workers=1, output=None,
+                      image_format="lossless", jpeg_quality=DEFAULT_JPEG_QUALITY, card_cache=None, progress=None,
+                      timings=NULL_TIMINGS, dpi=None, draft=False, vector_text=False, group_by=None,
+                      separator_pages=False, prefetch=PHOTO_PREFETCH_DEPTH):
+    """
+    Lay out one card per student on a grid and return a binary file positioned at 0.
+    `output` may be any writable binary file; by default a SpooledTemporaryFile is used
+    so large runs land on disk instead of being held in worker RAM next to the response.
+    `image_format` is one of CARD_IMAGE_FORMATS (see encode_card); "layered" embeds the
+    background once and only each student's photo/text layer per card. An optional
+    `card_cache` (idms.card_cache.RenderedCardCache) skips re-rendering unchanged cards.
+    `progress`, if given, is called with the running card count after each card is placed.
+    Pass a RenderTimings as `timings` to collect per-phase durations for the run.
+    `dpi` sets the card raster resolution (default: template.render_dpi, else the
+    background's native pixel size); `draft` trades photo fidelity for speed (proof sheets).
+    With `vector_text` text fields are drawn on the canvas as TTF text (same fit and
+    alignment as the raster) and only the background and photos are images.
+    `group_by(student)` returns a group label (e.g. the classroom); students must come
+    grouped, and each new group starts on a fresh page, preceded by a page naming the
+    group when `separator_pages` is set. `prefetch` is the photo read-ahead depth of a
+    single-process run (see iter_card_images).
+    """
+    if image_format not in CARD_IMAGE_FORMATS:
+        raise ValueError(f"image_format must be one of {CARD_IMAGE_FORMATS}")
+    paper_w_pt, paper_h_pt = paper_size_pt(paper)
+    card_w_pt, card_h_pt = card_size_pt(template)
     margin_pt = mm_to_pt(margin_mm)
     spacing_pt = mm_to_pt(spacing_mm)
 
@@ -348,37 +1116,94 @@ def generate_id_cards(students, template, paper="A4", margin_mm=10, spacing_mm=3
         paper_w_pt, paper_h_pt, card_w_pt, card_h_pt, margin_pt, spacing_pt
     )
 
-    buf = io.BytesIO()
+    buf = output if output is not None else tempfile.SpooledTemporaryFile(max_size=PDF_SPOOL_MAX_BYTES)
     c = canvas.Canvas(buf, pagesize=(paper_w_pt, paper_h_pt))
 
+    layered = image_format == "layered"
+    if layered:
+        # the background goes into the file once, as a form XObject every cell refers to
+        with timings.phase("background"):
+            plan = compile_template(template, dpi, draft=draft, vector_text=vector_text)
+            bg = background_cache.get(template, plan.size).convert("RGB")
+        c.beginForm(LAYERED_BACKGROUND_FORM, 0, 0, card_w_pt, card_h_pt)
+        c.drawImage(ImageReader(bg), 0, 0, width=card_w_pt, height=card_h_pt)
+        c.endForm()
+
     count = 0
     page = 0
-    for student in students:
-        card_img = render_card_image(student, template)
-        tmp = io.BytesIO()
-        card_img.save(tmp, format="PNG")
-        tmp.seek(0)
-        img = ImageReader(tmp)
+    slot = 0  # cards on the current page
+    group = _NO_GROUP
+    run_start = time.perf_counter()
+    queued = None
+    if vector_text:
+        plan = compile_template(template, dpi, draft=draft, vector_text=True)
+        card_px = plan.size or background_cache.native_size(template)
+    if vector_text or group_by is not None:
+        # cards come back in input order: remember each student until its card arrives
+        queued = deque()
 
-        idx = count % per_page
-        col = idx % cols
-        row = idx // cols
+        def remember(students):
+            for st in students:
+                queued.append(st)
+                yield st
+        students = remember(students)
+
+    cards = iter_card_images(students, template, workers=workers, image_format=image_format,
+                             jpeg_quality=jpeg_quality, card_cache=card_cache, timings=timings, dpi=dpi,
+                             draft=draft, vector_text=vector_text, prefetch=prefetch)
+    for encoded in cards:
+        student = queued.popleft() if queued is not None else None
+        if group_by is not None:
+            label = group_by(student)
+            if label != group:
+                if slot:
+                    with timings.phase("page"):
+                        c.showPage()
+                    page += 1
+                    slot = 0
+                if max_pages and page >= max_pages:
+                    break
+                if separator_pages:
+                    _draw_separator_page(c, label, paper_w_pt, paper_h_pt)
+                    page += 1
+                group = label
+
+        embed_start = time.perf_counter()
+        col = slot % cols
+        row = slot // cols
 
         x_pt = x_start_pt + col * (card_w_pt + spacing_pt)
         y_pt = y_top_pt - row * (card_h_pt + spacing_pt) - card_h_pt
 
-        c.drawImage(img, x_pt, y_pt, width=card_w_pt, height=card_h_pt)
+        if layered:
+            _draw_layered_card(c, encoded, x_pt, y_pt, card_w_pt, card_h_pt)
+        else:
+            c.drawImage(card_image_reader(encoded), x_pt, y_pt, width=card_w_pt, height=card_h_pt)
+        if vector_text:
+            draw_vector_text(c, student, plan, card_px, x_pt, y_pt, card_w_pt, card_h_pt, timings)
+        timings.add("embed", time.perf_counter() - embed_start)
 
         count += 1
-        if count % per_page == 0:
-            c.showPage()
+        slot += 1
+        if progress:
+            progress(count)
+        if slot == per_page:
+            with timings.phase("page"):
+                c.showPage()
             page += 1
+            slot = 0
             if max_pages and page >= max_pages:
                 break
 
-    if count % per_page != 0:
+    if slot:
         c.showPage()
+        page += 1
 
-    c.save()
-    buf.seek(0)
+    with timings.phase("pdf_save"):
+        c.save()
+    timings.add("run", time.perf_counter() - run_start)
+    timings.count("cards", count)
+    timings.count("pages", page)
+    if buf.seekable():
+        buf.seek(0)
     return buf
@@ -1,32 +1,43 @@
 from rest_framework import viewsets, status, permissions
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
+from django.http import Http404
 from django.shortcuts import get_object_or_404
 from django.utils.dateparse import parse_date
 from django.db import IntegrityError, transaction
 
 from .models import School, ClassRoom, Student, UploadLink, SubmissionIndex
 from .serializers import SchoolSerializer, ClassRoomSerializer, StudentSerializer, ParentSubmissionSerializer
+from .photos import queue_photo
+from .link_cache import payload_is_valid, resolve_link
+
+
+def _public_link(token):
+    """Cached payload of the link (see idms.link_cache); 404 like get_object_or_404."""
+    payload = resolve_link(token)
+    if payload is None:
+        raise Http404("No UploadLink matches the given query.")
+    return payload
 
 @api_view(["GET"])
 @permission_classes([permissions.AllowAny])
 def public_form_schema(request, token):
     """Return the dynamic form schema for this token."""
-    link = get_object_or_404(UploadLink, token=token)
+    link = _public_link(token)
 
-    if not link.is_valid():
+    if not payload_is_valid(link):
         return Response({"detail": "Link is invalid or expired."}, status=400)
     
-    if not link.template_id or not link.template.fields:
+    if not link["template_id"] or not link["fields"]:
         return Response({"detail": "No form template configured for this link."}, status=400)    
 
     return Response({
-        "school": link.school.name,
-        "class": link.classroom.class_name,
-        "section": link.classroom.section,
-        "expires_at": link.expires_at,
-        "fields": link.template.fields,
-        "template_id": link.template_id,
+        "school": link["school"],
+        "class": link["class"],
+        "section": link["section"],
+        "expires_at": link["expires_at"],
+        "fields": link["fields"],
+        "template_id": link["template_id"],
         "source": "template"
     })
 
@@ -36,7 +47,7 @@ CORE_MAPPABLE = {"full_name","dob","gender","parent_email","parent_phone","photo
 @api_view(["POST"])
 @permission_classes([permissions.AllowAny])
 def public_submit_student(request, token):
-    link = get_object_or_404(UploadLink, token=token)
+    link = get_object_or_404(UploadLink.objects.select_related("school", "classroom", "template"), token=token)
     if not link.is_valid():
         return Response({"detail": "Link is invalid or expired."}, status=400)
 
@@ -115,6 +126,10 @@ def public_submit_student(request, token):
 
     # 3) Enforce unique constraints per school
     # DB-level: we’ll create SubmissionIndex rows; if conflict, error out.
+    if core_kwargs.get("photo"):
+        # orientation / metadata / print-size derivative happen in the photo worker, not here
+        queue_photo(core_kwargs)
+
     try:
         with transaction.atomic():
             student = Student.objects.create(**core_kwargs, meta=meta)
@@ -127,9 +142,13 @@ def public_submit_student(request, token):
                     student=student
                 )
 
-            # success → increment token usage
-            link.uses_count += 1
-            link.save()
+            # success → count it against the link; claimed last so the row lock is held briefly.
+            # A link used up (or expired) since the check above rolls the submission back.
+            if not link.claim_use():
+                transaction.set_rollback(True)
+                if student.photo:
+                    student.photo.delete(save=False)
+                return Response({"detail": "Link is invalid or expired."}, status=400)
 
     except IntegrityError:
         return Response(
@@ -163,14 +182,14 @@ class StudentViewSet(viewsets.ModelViewSet):
 @api_view(["GET"])
 def public_link_info(request, token):
     """Parents app can fetch what class/school the link corresponds to (and check validity)."""
-    link = get_object_or_404(UploadLink, token=token)
-    if not link.is_valid():
+    link = _public_link(token)
+    if not payload_is_valid(link):
         return Response({"detail": "Link is invalid or expired."}, status=400)
     return Response({
-        "school": link.school.name,
-        "class": link.classroom.class_name,
-        "section": link.classroom.section,
-        "expires_at": link.expires_at
+        "school": link["school"],
+        "class": link["class"],
+        "section": link["section"],
+        "expires_at": link["expires_at"]
     })
 
 @api_view(['GET'])
@@ -14,16 +14,20 @@ from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from django.utils import timezone
 from django.db.models import Count, Q
-from .models import School, ClassRoom, Student, UploadLink, FormTemplate, IdCardTemplate, User
+from .models import School, ClassRoom, Student, UploadLink, FormTemplate, IdCardTemplate, User, GenerationJob
 import uuid
 from .permissions import IsSuperAdmin, IsSchoolAdmin, IsSameSchoolOrSuper, IsSuperOrSchoolAdmin, SuperAdminWrite_SchoolAdminRead,SchoolAdminCreateOnly
 from .serializers import *  # your serializers
-from .utils import render_card_image
-from django.http import FileResponse
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.timezone import now
 from django.template import Template, Context
 from xhtml2pdf import pisa
 import io
-from .utils import generate_id_cards
+from .utils import compute_grid, mm_to_pt, PAPER_SIZES
+from .previews import (PreviewError, apply_preview_params, preview_response, parse_contact_sheet_params,
+                       contact_sheet_jpeg, contact_sheet_pdf)
+from .jobs import GenerationError, parse_generation_params, resolve_template, run_generation, stream_generation_zip
 
 from .serializers import ChangePasswordSerializer
 import secrets
@@ -234,27 +238,29 @@ class StudentViewSet(viewsets.ModelViewSet):
     
     @action(detail=False, methods=["get"], permission_classes=[IsSuperAdmin])
     def generate_ids(self, request):
-        school_id = request.query_params.get("school")
-        class_id = request.query_params.get("classroom")
-        paper = request.query_params.get("paper", "A4")
-        # card_size optionally override: "54x86"
-        card_size = request.query_params.get("card_size")
-        students = Student.objects.filter(school_id=school_id, classroom_id=class_id, status="VERIFIED")
+        """
+        Render the class PDF inline. Big classes should use POST /generation-jobs/ instead.
+        Query params: school, classroom, paper, card_size ("54x86"), dpi, workers, image_format, quality,
+        vector_text, timings
+        Without classroom the whole school is printed in one run, class by class;
+        class_breaks=page|separator|none sets what goes between classes (default page).
+        split=classroom|pages (+ pages_per_file) returns a ZIP of PDFs instead, streamed as
+        each one is rendered.
+        """
         try:
-            tmpl = IdCardTemplate.objects.get(school_id=school_id, is_default=True)
-        except IdCardTemplate.DoesNotExist:
-            return Response({"detail": "No default ID card template for this school."}, status=400)
-
-        # optionally override template.card_size_mm if card_size passed
-        if card_size:
-            try:
-                w,h = card_size.split("x")
-                tmpl.card_size_mm = {"w": float(w), "h": float(h)}
-            except Exception:
-                pass
-
-        pdf_buf = generate_id_cards(students, tmpl, paper=paper)
-        return FileResponse(pdf_buf, as_attachment=True, filename="idcards.pdf")
+            params = parse_generation_params(request.query_params)
+            tmpl = resolve_template(params)
+        except GenerationError as e:
+            return Response({"detail": str(e)}, status=400)
+
+        if params["split"]:
+            response = StreamingHttpResponse(stream_generation_zip(params, tmpl), content_type="application/zip")
+            response["Content-Disposition"] = 'attachment; filename="idcards.zip"'
+            return response
+
+        # spooled to disk past a few MB; FileResponse streams it in blocks and closes it after
+        pdf_file = run_generation(params, template=tmpl)
+        return FileResponse(pdf_file, as_attachment=True, filename="idcards.pdf", content_type="application/pdf")
     
     @action(detail=True, methods=["post"], url_path="mark-id-generated")
     def mark_id_generated(self, request, pk=None):
@@ -376,15 +382,21 @@ class IdCardTemplateViewSet(viewsets.ModelViewSet):
         if instance.is_default:
             IdCardTemplate.objects.filter(school=instance.school).exclude(id=instance.id).update(is_default=False)
 
-    @action(detail=True, methods=["get"], url_path="preview")
+    @action(detail=True, methods=["get", "post"], url_path="preview")
     def preview(self, request, pk=None):
         """
         Returns a JPEG preview of a single sample student rendered with this template.
         Query params:
            student_id (optional) - use a real student
            sample=true - use synthetic sample
+           scale=0.25 / max_px=600 (optional) - fast low-res draft
+        POST body may also carry unsaved {"fields": {...}} overrides (per field).
         """
         tpl = get_object_or_404(IdCardTemplate, pk=pk)
+        try:
+            size = apply_preview_params(tpl, request.query_params, request.data)
+        except PreviewError as e:
+            return Response({"detail": str(e)}, status=400)
         student_id = request.query_params.get("student_id")
         student = None
         if student_id:
@@ -421,12 +433,8 @@ class IdCardTemplateViewSet(viewsets.ModelViewSet):
             # add a dummy blank photo so paste_photo skips gracefully
             student.photo = None
 
-        # render PIL image
-        img = render_card_image(student, tpl)
-        buf = BytesIO()
-        img.save(buf, format="JPEG", quality=90)
-        buf.seek(0)
-        return HttpResponse(buf.read(), content_type="image/jpeg")
+        # ETag / Last-Modified aware; re-renders only when the template or student changed
+        return preview_response(request, student, tpl, size)
 
     @action(detail=True, methods=["get"], url_path="grid")
     def grid(self, request, pk=None):
@@ -469,13 +477,18 @@ class IdCardTemplateViewSet(viewsets.ModelViewSet):
         })
     
 
-    @action(detail=True, methods=["get"], url_path="preview-for-student")
+    @action(detail=True, methods=["get", "post"], url_path="preview-for-student")
     def preview_for_student(self, request, pk=None):
         """
         GET /api/id-templates/{pk}/preview-for-student/?student_id=123
         Returns a JPG preview of the ID for the given student rendered with this template.
+        Accepts the same scale / max_px / fields draft options as preview.
         """
         tpl = self.get_object()
+        try:
+            size = apply_preview_params(tpl, request.query_params, request.data)
+        except PreviewError as e:
+            return Response({"detail": str(e)}, status=400)
         student_id = request.query_params.get("student_id")
         student = None
         if student_id:
@@ -497,11 +510,71 @@ class IdCardTemplateViewSet(viewsets.ModelViewSet):
                     student.meta[k] = getattr(student, k)
                 student.photo = None
 
-        img = render_card_image(student, tpl)  # PIL image
-        buf = BytesIO()
-        img.save(buf, format="JPEG", quality=90)
-        buf.seek(0)
-        return HttpResponse(buf.read(), content_type="image/jpeg")
+        return preview_response(request, student, tpl, size)
+
+    @action(detail=True, methods=["get"], url_path="contact-sheet")
+    def contact_sheet(self, request, pk=None):
+        """
+        GET /api/id-templates/{pk}/contact-sheet/?classroom=3  (or ?student_ids=1,2,3)
+        One image of draft thumbnails for QA before printing, paginated with
+        page / per_page (default 60); X-Total-Count / X-Page-Count headers.
+        output=pdf returns all cards in print layout at low resolution instead.
+        Optional: thumb_px (at most 600), cols, paper (pdf).
+        """
+        tpl = self.get_object()
+        try:
+            opts = parse_contact_sheet_params(tpl, request.query_params)
+        except PreviewError as e:
+            return Response({"detail": str(e)}, status=400)
+
+        if opts["format"] == "pdf":
+            pdf = contact_sheet_pdf(opts["students"], tpl, paper=opts["paper"])
+            return FileResponse(pdf, filename="contact-sheet.pdf", content_type="application/pdf")
+
+        total = opts["students"].count()
+        start = (opts["page"] - 1) * opts["per_page"]
+        students = opts["students"][start:start + opts["per_page"]]
+        response = HttpResponse(contact_sheet_jpeg(students, tpl, opts["thumb_px"], opts["cols"]),
+                                content_type="image/jpeg")
+        response["X-Total-Count"] = total
+        response["X-Page-Count"] = max(1, -(-total // opts["per_page"]))
+        return response
+
+class GenerationJobViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    Background ID-card generation.
+    POST   /generation-jobs/                 same params as students/generate_ids -> queued job
+    GET    /generation-jobs/{id}/            status, done/total, eta_seconds
+    GET    /generation-jobs/{id}/download/   the PDF once status is DONE
+    """
+    serializer_class = GenerationJobSerializer
+    queryset = GenerationJob.objects.select_related("school", "classroom").all().order_by("-id")
+    permission_classes = [IsSuperAdmin]
+
+    def create(self, request):
+        try:
+            params = parse_generation_params(request.data)
+            resolve_template(params)  # fail fast instead of queueing a job that cannot run
+        except GenerationError as e:
+            return Response({"detail": str(e)}, status=400)
+        if params["split"]:
+            return Response({"detail": "split output is only available from students/generate_ids."}, status=400)
+        if params["classroom"] and not ClassRoom.objects.filter(id=params["classroom"], school_id=params["school"]).exists():
+            return Response({"detail": "Classroom not found for this school."}, status=400)
+
+        job = GenerationJob.objects.create(
+            school_id=params["school"], classroom_id=params["classroom"],
+            requested_by=request.user, params=params,
+        )
+        return Response(GenerationJobSerializer(job).data, status=status.HTTP_201_CREATED)
+
+    @action(detail=True, methods=["get"])
+    def download(self, request, pk=None):
+        job = self.get_object()
+        if job.status != "DONE" or not job.result:
+            return Response({"detail": f"Job is {job.status.lower()}; no file yet."}, status=409)
+        return FileResponse(job.result.open("rb"), as_attachment=True,
+                            filename=f"idcards-{job.id}.pdf", content_type="application/pdf")
 
 class DashboardViewSet(APIView):
     permission_classes = [IsAuthenticated]
@@ -12,6 +12,7 @@ type Student = {
   classroom?: number;
   meta?: Record<string, any>;
   photo?: string;
+  photo_thumb?: string | null; // small normalized copy, once the photo worker has run
 };
 
 type ClassRoom = { id: number; class_name: string; section?: string | null };
@@ -247,7 +248,7 @@ export default function SchoolSubmissions() {
               if (!s) return null;
 
               let rawPhoto =
-                s.photo || s.meta?.photo || s.meta?.student_photo;
+                s.photo_thumb || s.photo || s.meta?.photo || s.meta?.student_photo;
               let photoUrl = rawPhoto;
               if (rawPhoto && !rawPhoto.startsWith("http")) {
                 photoUrl = `${import.meta.env.VITE_API_BASE_URL}${rawPhoto}`;